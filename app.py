@@ -4,9 +4,12 @@ from PIL import Image
 import os
 import io
 from dotenv import load_dotenv
-import requests
-import json
-import base64
+import core
+import backgrounds
+import client
+from image_dedup import PerceptualHashIndex, dedupe_uploads
+from history import HistoryStore
+from usage import UsageStore
 
 # Load environment variables (for local development)
 load_dotenv()
@@ -22,6 +25,32 @@ def get_api_key():
     # Fallback to environment variable (for local development)
     return os.getenv("GOOGLE_API_KEY", "")
 
+# URL of the headless generation service (service.py), if the app should use it
+def get_service_url():
+    try:
+        if hasattr(st, 'secrets') and 'GIFT_SERVICE_URL' in st.secrets:
+            return st.secrets['GIFT_SERVICE_URL']
+    except:
+        pass
+    return os.getenv("GIFT_SERVICE_URL", "")
+
+# Shared across sessions so near-duplicate uploads map to one canonical asset
+@st.cache_resource
+def get_phash_index():
+    return PerceptualHashIndex()
+
+@st.cache_resource
+def get_history_store():
+    return HistoryStore()
+
+@st.cache_resource
+def get_usage_store():
+    return UsageStore()
+
+@st.cache_resource
+def get_background_library():
+    return backgrounds.BackgroundLibrary()
+
 # Configure page
 st.set_page_config(
     page_title="Gift Image Creator",
@@ -350,11 +379,28 @@ with st.sidebar:
     st.header("設定")
     default_api_key = get_api_key()
     api_key_input = st.text_input("Google API Key", type="password", value=default_api_key)
-    model_name = st.text_input("Model ID", value="gemini-3-pro-image-preview")
-    st.caption("デフォルト: gemini-3-pro-image-preview")
+    model_name = st.text_input("Model ID", value=core.DEFAULT_MODEL)
+    st.caption(f"デフォルト: {core.DEFAULT_MODEL}")
+    service_url = get_service_url()
+    if service_url:
+        st.caption(f"生成サービス: {service_url}")
+    st.page_link("pages/1_履歴.py", label="生成履歴", icon="🕘")
+
+# Convert the selected template (file path) or reference design (UploadedFile) for the core pipeline
+def load_template(template_image_path):
+    if not template_image_path:
+        return None
+    if hasattr(template_image_path, 'read'):
+        template_image_path.seek(0)
+        return {
+            "label": f"参照デザイン: {template_image_path.name}",
+            "data": template_image_path.getvalue(),
+            "mime_type": template_image_path.type,
+        }
+    return core.load_template_file(os.path.basename(template_image_path))
 
 # Function to generate image
-def generate_image(uploaded_files, main_text, sub_text, prompt_style, aspect_ratio, template_image_path=None, modification_instruction=""):
+def generate_image(uploaded_files, main_text, sub_text, prompt_style, aspect_ratio, template_image_path=None, modification_instruction="", campaign=None, tag=None, mode="quality"):
     if not uploaded_files:
         return None, "画像をアップロードしてください。"
     
@@ -368,147 +414,47 @@ def generate_image(uploaded_files, main_text, sub_text, prompt_style, aspect_rat
     """, unsafe_allow_html=True)
     
     try:
-        # Prepare inputs for REST API
-        
-        # Construct the prompt
-        base_prompt = f"""
-        Create a high-quality, premium gift selection image.
-        
-        Input Images: Use these product images as the main subjects.
-        
-        Text Content:
-        - Main Text: "{main_text}" (Make this prominent and elegant)
-        - Sub Text: "{sub_text}" (Smaller, complementary text)
-        
-        Style/Atmosphere: {prompt_style}
-        
-        Requirements:
-        - Professional product photography style.
-        - If multiple images are provided, arrange them tastefully.
-        - Add a "Choice" or "Gift" theme background.
-        - Make it look like a high-end e-commerce banner.
-        - Ensure text is legible and integrated into the design.
-        """
-        
-        if template_image_path:
-             base_prompt += "\n\nReference Design: Please use the provided reference image as a layout and style guide."
-        
-        if modification_instruction:
-            base_prompt += f"\n\nMODIFICATION REQUEST: {modification_instruction}\nPlease regenerate the image applying these changes while keeping the original intent."
-
-        contents_parts = [{"text": base_prompt}]
-        
-        # Add Template Image if selected (can be file path or UploadedFile object)
-        if template_image_path:
-            try:
-                # Check if it's an UploadedFile object (custom reference) or a file path (template)
-                if hasattr(template_image_path, 'read'):
-                    # It's an UploadedFile object
-                    template_image_path.seek(0)
-                    template_bytes = template_image_path.getvalue()
-                elif os.path.exists(template_image_path):
-                    # It's a file path
-                    with open(template_image_path, "rb") as f:
-                        template_bytes = f.read()
-                else:
-                    template_bytes = None
-                
-                if template_bytes:
-                    template_base64 = base64.b64encode(template_bytes).decode('utf-8')
-                    
-                    # Determine mime type
-                    if hasattr(template_image_path, 'type'):
-                        # UploadedFile has a type attribute
-                        mime_type = template_image_path.type
-                    else:
-                        # File path - determine from extension
-                        ext = os.path.splitext(template_image_path)[1].lower()
-                        mime_type = "image/png" if ext == ".png" else "image/jpeg"
-                    
-                    contents_parts.append({
-                        "inline_data": {
-                            "mime_type": mime_type,
-                            "data": template_base64
-                        }
-                    })
-            except Exception as e:
-                print(f"Error loading template: {e}")
-
+        images = []
         for file in uploaded_files:
             # Reset file pointer
             file.seek(0)
-            bytes_data = file.getvalue()
-            base64_data = base64.b64encode(bytes_data).decode('utf-8')
-            mime_type = file.type
-            contents_parts.append({
-                "inline_data": {
-                    "mime_type": mime_type,
-                    "data": base64_data
-                }
-            })
-
-        # Construct payload
-        payload = {
-            "contents": [
-                {
-                    "parts": contents_parts
-                }
-            ],
-            "generationConfig": {
-                "responseModalities": ["IMAGE"],
-                "imageConfig": {
-                    "aspectRatio": aspect_ratio
-                }
-            }
+            images.append((file.getvalue(), file.name))
+
+        request = {
+            "images": images,
+            "main_text": main_text,
+            "sub_text": sub_text,
+            "prompt_style": prompt_style,
+            "aspect_ratio": aspect_ratio,
+            "model": model_name,
+            "template": load_template(template_image_path),
+            "modification_instruction": modification_instruction,
+            "campaign": campaign,
+            "tag": tag,
+            "mode": mode,
         }
 
-        # API Endpoint
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent?key={api_key_input}"
-        
-        headers = {
-            "Content-Type": "application/json"
-        }
+        # Use the headless service when configured, otherwise run the pipeline in-process
+        if service_url:
+            result, error = client.run_generation(service_url, request)
+        elif mode == "fast":
+            result, error = backgrounds.run_composite(request, get_background_library(), get_phash_index(), get_history_store())
+        else:
+            result, error = core.run_generation(request, api_key_input, get_phash_index(), get_history_store(), get_usage_store(), source="app")
 
-        response = requests.post(url, headers=headers, data=json.dumps(payload))
-        
         # Clear animation
         placeholder.empty()
-        
-        if response.status_code == 200:
-            result = response.json()
-            try:
-                candidates = result.get("candidates", [])
-                if candidates:
-                    parts = candidates[0].get("content", {}).get("parts", [])
-                    image_part = None
-                    for part in parts:
-                        if "inlineData" in part:
-                            image_part = part["inlineData"]
-                            break
-                    
-                    if image_part:
-                        image_data = base64.b64decode(image_part["data"])
-                        image = Image.open(io.BytesIO(image_data))
-                        
-                        # Save to session state
-                        st.session_state.generated_image = image
-                        
-                        buf = io.BytesIO()
-                        image.save(buf, format="PNG")
-                        byte_im = buf.getvalue()
-                        st.session_state.generated_image_data = byte_im
-                        
-                        return image, None
-                    else:
-                        return None, "画像が生成されませんでした。レスポンスに画像データが含まれていません。"
-                else:
-                    return None, "生成候補が見つかりませんでした。"
-            except Exception as parse_error:
-                return None, f"レスポンスの解析に失敗しました: {str(parse_error)}"
-        else:
-            if response.status_code == 429:
-                return None, "APIエラー: 429 (利用枠超過)。サイドバーでモデルIDを変更してみてください。"
-            return None, f"APIエラー: {response.status_code}\n{response.text}"
+
+        if error:
+            return None, error
+
+        image = Image.open(io.BytesIO(result["image_data"]))
+
+        # Save to session state
+        st.session_state.generated_image = image
+        st.session_state.generated_image_data = result["image_data"]
+
+        return image, None
 
     except Exception as e:
         placeholder.empty()
@@ -516,11 +462,13 @@ def generate_image(uploaded_files, main_text, sub_text, prompt_style, aspect_rat
 
 
 # Main Content
-if not api_key_input:
+# The API key is only needed here when generating in-process; the service holds its own
+if not api_key_input and not service_url:
     st.warning("APIキーが設定されていません。.envファイルを設定するか、サイドバーで入力してください。")
 else:
     # Configure GenAI
-    genai.configure(api_key=api_key_input)
+    if api_key_input:
+        genai.configure(api_key=api_key_input)
 
     # Step 1: Image Upload
     st.markdown('<div class="section-header">商品画像アップロード</div>', unsafe_allow_html=True)
@@ -532,6 +480,13 @@ else:
             with cols[idx]:
                 st.image(file, use_container_width=True)
 
+        try:
+            _, duplicate_names = dedupe_uploads(uploaded_files, get_phash_index())
+            if duplicate_names:
+                st.info(f"同じ商品画像と思われるファイルが含まれているため、生成時は1枚として扱います: {', '.join(duplicate_names)}")
+        except Exception as e:
+            print(f"Error checking duplicate uploads: {e}")
+
     st.markdown("---")
 
     # Step 2: Configuration
@@ -663,14 +618,7 @@ else:
     st.markdown('<div class="section-header">AIへの指示</div>', unsafe_allow_html=True)
     
     # Tag Buttons
-    tag_prompts = {
-        "パステルカラー": "パステルカラーを基調とした、ふんわりと優しい雰囲気のデザイン。明るく柔らかい光の演出を加え、可愛らしさと幸福感を表現してください。",
-        "高級感": "黒やゴールド、深い色合いを使用した、シックで高級感のあるデザイン。洗練されたフォントとレイアウトで、プレミアムなギフトであることを強調してください。",
-        "シンプル": "余計な装飾を削ぎ落とした、ミニマルで洗練されたデザイン。余白を活かし、商品画像とテキストが際立つように清潔感のある構成にしてください。",
-        "ポップ": "鮮やかな色使いと元気な印象を与えるポップなデザイン。動きのあるレイアウトや幾何学模様を取り入れ、楽しさとワクワク感を演出してください。",
-        "和風": "和紙の質感や伝統的な和柄（麻の葉、青海波など）を取り入れた、落ち着きのある和風デザイン。上品で奥ゆかしい雰囲気を表現してください。",
-        "季節感（冬）": "雪の結晶やキラキラとした光、寒色系のカラーパレットを使用した冬らしいデザイン。温かみのあるギフトとしての魅力を引き立てる、幻想的な雰囲気にしてください。"
-    }
+    tag_prompts = core.TAG_PROMPTS
     
     # Helper to update prompt (Overwrite)
     def update_prompt(prompt_text):
@@ -692,6 +640,36 @@ else:
         key="prompt_style_input"
     )
 
+    # Campaign name is only used to organize the history page
+    st.markdown('<div class="sub-label">キャンペーン名（任意）</div>', unsafe_allow_html=True)
+    campaign = st.text_input(
+        "キャンペーン名",
+        placeholder="例: 2025冬ギフト",
+        label_visibility="collapsed"
+    )
+
+    # Record which preset was used, if the instruction still matches one
+    selected_tag = None
+    for label, prompt_text in tag_prompts.items():
+        if prompt_style.strip() == prompt_text:
+            selected_tag = label
+            break
+
+    # Fast mode composites onto a pre-generated background locally, without the API.
+    # It is hidden when no Japanese font is available to draw the text.
+    generation_mode = "高品質モード"
+    if backgrounds.is_available():
+        st.markdown('<div class="sub-label">生成モード</div>', unsafe_allow_html=True)
+        generation_mode = st.radio(
+            "生成モード",
+            options=["高品質モード", "高速モード"],
+            index=0,
+            horizontal=True,
+            label_visibility="collapsed"
+        )
+    if generation_mode == "高速モード":
+        st.caption("事前に用意した背景に商品画像と文言を合成します（AIへの指示はタグのみ反映されます）")
+
     st.markdown("---")
 
     # Step 3: Generate
@@ -699,7 +677,7 @@ else:
     
     # Button will be centered via CSS
     if st.button("画像を生成する", type="primary"):
-        image, error = generate_image(uploaded_files, main_text, sub_text, prompt_style, aspect_ratio, final_template_path)
+        image, error = generate_image(uploaded_files, main_text, sub_text, prompt_style, aspect_ratio, final_template_path, campaign=campaign.strip(), tag=selected_tag, mode="fast" if generation_mode == "高速モード" else "quality")
         if error:
             st.error(error)
         # Success is handled by session state update in function
@@ -758,7 +736,7 @@ else:
                 combined_prompt = f"{prompt_style}\n\n【変更指示】\n{modification_prompt}"
                 
                 # Generate with the previous image as reference
-                image, error = generate_image(uploaded_files, main_text, sub_text, combined_prompt, aspect_ratio, reference_image)
+                image, error = generate_image(uploaded_files, main_text, sub_text, combined_prompt, aspect_ratio, reference_image, campaign=campaign.strip(), tag=selected_tag)
                 if error:
                     st.error(error)
                 else:
@@ -0,0 +1,439 @@
+import os
+import io
+import json
+import hashlib
+import threading
+import time
+import argparse
+from collections import OrderedDict
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter, ImageFont
+from dotenv import load_dotenv
+
+import core
+import usage
+from image_dedup import dedupe_images
+from usage import UsageStore
+
+# Pre-generated style backgrounds and local compositing ("高速モード").
+# An offline job renders one product-free background per tag x aspect ratio x
+# template. At request time the user's products and text are composited onto
+# the matching background locally, without any API call.
+#
+#   python backgrounds.py build                 # fill in missing backgrounds
+#   python backgrounds.py build --tag 和風 --force
+
+CACHE_DIR = os.getenv("GIFT_CACHE_DIR", ".cache")
+LIBRARY_DIR = os.path.join(CACHE_DIR, "backgrounds")
+MANIFEST_PATH = os.path.join(LIBRARY_DIR, "manifest.json")
+
+LOCAL_MODEL = "local-composite"
+
+# Pause between API calls so a full build stays under the rate limit
+BUILD_DELAY_SECONDS = 5
+RATE_LIMIT_BACKOFF_SECONDS = 60
+MAX_BUILD_ATTEMPTS = 3
+
+# Layout, as fractions of the background height
+TEXT_TOP = 0.06
+MAIN_TEXT_SIZE = 0.075
+SUB_TEXT_SIZE = 0.038
+PRODUCT_AREA_TOP = 0.30
+PRODUCT_AREA_BOTTOM = 0.92
+PRODUCT_MARGIN = 0.04
+# Products wrap to another row rather than get narrower than this (fraction of width)
+MIN_SLOT_WIDTH = 0.12
+
+# Decoded backgrounds kept in memory per process (full library is 150 images)
+BACKGROUND_CACHE_SIZE = 12
+
+# Pixels this far (RGB distance) from the estimated backdrop color count as product
+CUTOUT_THRESHOLD = 40
+
+# Searched in order when GIFT_FONT_PATH is not set; the first that can render
+# Japanese is used. Without one, fast mode is unavailable.
+FONT_CANDIDATES = [
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Bold.ttc",
+    "/usr/share/fonts/noto-cjk/NotoSansCJK-Bold.ttc",
+    "/usr/share/fonts/truetype/fonts-japanese-gothic.ttf",
+    "/System/Library/Fonts/ヒラギノ角ゴシック W6.ttc",
+    "C:/Windows/Fonts/meiryob.ttc",
+    "C:/Windows/Fonts/msgothic.ttc",
+]
+
+
+def template_files():
+    return sorted(
+        name for name in os.listdir(core.TEMPLATE_DIR)
+        if os.path.splitext(name)[1].lower() in (".png", ".jpg", ".jpeg")
+    )
+
+
+def build_background_prompt(tag, has_template=False):
+    prompt = f"""
+        Create a background image for a premium gift selection e-commerce banner.
+
+        Style/Atmosphere: {core.TAG_PROMPTS[tag]}
+
+        Requirements:
+        - Do NOT include any products, people, text, letters, logos or watermarks.
+        - Leave the lower two thirds open as a clean stage or surface where product photos will be placed later.
+        - Keep the top area calm and uncluttered so a headline can be placed over it.
+        - Add a "Choice" or "Gift" theme through decoration at the edges only.
+        """
+    if has_template:
+        prompt += "\n\nReference Design: Please use the provided reference image as a color and layout guide, but leave out its products and text."
+    return prompt
+
+
+class BackgroundLibrary:
+    def __init__(self, library_dir=LIBRARY_DIR, manifest_path=MANIFEST_PATH):
+        self.library_dir = library_dir
+        self.manifest_path = manifest_path
+        self._lock = threading.Lock()
+        self._manifest = {}
+        self._cache = OrderedDict()
+        self.reload()
+
+    @staticmethod
+    def _key(tag, aspect_ratio, template):
+        return f"{tag}|{aspect_ratio}|{template or ''}"
+
+    def reload(self):
+        # Picks up backgrounds added by a build running in another process
+        if not os.path.exists(self.manifest_path):
+            return
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Error loading background manifest: {e}")
+            return
+        with self._lock:
+            self._manifest = manifest
+
+    def _save(self):
+        os.makedirs(self.library_dir, exist_ok=True)
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._manifest, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.manifest_path)
+
+    def has(self, tag, aspect_ratio, template=None):
+        return self._key(tag, aspect_ratio, template) in self._manifest
+
+    def add(self, tag, aspect_ratio, template, image_data):
+        file_name = hashlib.sha256(image_data).hexdigest() + ".png"
+        os.makedirs(self.library_dir, exist_ok=True)
+        with open(os.path.join(self.library_dir, file_name), "wb") as f:
+            f.write(image_data)
+        with self._lock:
+            self._manifest[self._key(tag, aspect_ratio, template)] = file_name
+            self._save()
+
+    def get(self, tag, aspect_ratio, template=None):
+        # Falls back to the template-less background for the same tag and ratio.
+        # Returns a decoded RGB image, or None if nothing was pre-generated.
+        keys = (self._key(tag, aspect_ratio, template), self._key(tag, aspect_ratio, None))
+        if not any(key in self._manifest for key in keys):
+            # A build may have added it since this library was loaded
+            self.reload()
+        for key in keys:
+            file_name = self._manifest.get(key)
+            if not file_name:
+                continue
+            with self._lock:
+                if file_name in self._cache:
+                    self._cache.move_to_end(file_name)
+                    return self._cache[file_name]
+            path = os.path.join(self.library_dir, file_name)
+            if not os.path.exists(path):
+                continue
+            # Recently used backgrounds stay decoded, popular combinations repeat a lot
+            image = Image.open(path).convert("RGB")
+            with self._lock:
+                self._cache[file_name] = image
+                if len(self._cache) > BACKGROUND_CACHE_SIZE:
+                    self._cache.popitem(last=False)
+            return image
+        return None
+
+
+def build_library(api_key, model_name=core.DEFAULT_MODEL, tags=None, aspect_ratios=None,
+                  templates=None, force=False, library=None, usage_store=None):
+    library = library or BackgroundLibrary()
+    usage_store = usage_store or UsageStore()
+    tags = tags or list(core.TAG_PROMPTS)
+    aspect_ratios = aspect_ratios or core.ASPECT_RATIOS
+    templates = templates if templates is not None else [None] + template_files()
+
+    combinations = [
+        (tag, aspect_ratio, template)
+        for tag in tags
+        for aspect_ratio in aspect_ratios
+        for template in templates
+        if force or not library.has(tag, aspect_ratio, template)
+    ]
+    print(f"{len(combinations)} background(s) to generate")
+
+    failures = 0
+    for done, (tag, aspect_ratio, template_name) in enumerate(combinations, start=1):
+        template = core.load_template_file(template_name) if template_name else None
+        payload = core.build_payload(
+            build_background_prompt(tag, has_template=template is not None),
+            [],
+            aspect_ratio,
+            template,
+        )
+
+        for attempt in range(MAX_BUILD_ATTEMPTS):
+            result, error = core.call_model(api_key, model_name, payload, usage_store, {
+                "image_count": 0,
+                "template": template_name,
+                "tag": tag,
+                "source": usage.BUILD_SOURCE,
+            })
+            if not error:
+                break
+            if error.startswith("APIエラー: 429"):
+                time.sleep(RATE_LIMIT_BACKOFF_SECONDS)
+            else:
+                time.sleep(BUILD_DELAY_SECONDS)
+
+        label = f"[{done}/{len(combinations)}] {tag} {aspect_ratio} {template_name or '-'}"
+        if error:
+            failures += 1
+            print(f"{label}: {error}")
+        else:
+            library.add(tag, aspect_ratio, template_name, result["image_data"])
+            print(f"{label}: ok ({result['latency_ms'] / 1000:.1f}s)")
+        time.sleep(BUILD_DELAY_SECONDS)
+    return failures
+
+
+def _renders_japanese(path):
+    # Fonts without Japanese glyphs draw every character as the same missing-glyph box
+    try:
+        font = ImageFont.truetype(path, 32)
+    except OSError:
+        return False
+
+    def render(text):
+        image = Image.new("L", (240, 48), 0)
+        ImageDraw.Draw(image).text((0, 0), text, font=font, fill=255)
+        return image.tobytes()
+
+    sample = render("選べるギフト")
+    return any(sample) and sample != render("\ue000\ue001\ue002\ue003\ue004\ue005")
+
+
+@lru_cache(maxsize=1)
+def find_font_path():
+    # Returns a Japanese-capable font path, or None
+    font_path = os.getenv("GIFT_FONT_PATH")
+    candidates = [font_path] if font_path else FONT_CANDIDATES
+    for path in candidates:
+        if path and os.path.exists(path) and _renders_japanese(path):
+            return path
+    if font_path:
+        print(f"GIFT_FONT_PATH cannot render Japanese text: {font_path}")
+    return None
+
+
+def is_available():
+    # Fast mode needs a Japanese font for the banner text
+    return find_font_path() is not None
+
+
+@lru_cache(maxsize=32)
+def load_font(size):
+    font_path = find_font_path()
+    if font_path is None:
+        raise RuntimeError("No Japanese font available; set GIFT_FONT_PATH")
+    return ImageFont.truetype(font_path, size)
+
+
+def cut_out(image):
+    # Returns an RGBA product image cropped to its content.
+    # Uploads with transparency are used as-is; otherwise the backdrop color is
+    # estimated from the border and removed.
+    image = image.convert("RGBA")
+    pixels = np.asarray(image)
+    alpha = pixels[:, :, 3]
+
+    if alpha.min() == 255:
+        rgb = pixels[:, :, :3].astype(np.int16)
+        border = np.concatenate([rgb[0], rgb[-1], rgb[:, 0], rgb[:, -1]])
+        backdrop = np.median(border, axis=0)
+        distance = np.sqrt(((rgb - backdrop) ** 2).sum(axis=2))
+        mask = Image.fromarray(np.where(distance > CUTOUT_THRESHOLD, 255, 0).astype(np.uint8))
+        # Close small holes, then feather the edge
+        mask = mask.filter(ImageFilter.MaxFilter(5)).filter(ImageFilter.MinFilter(5))
+        mask = mask.filter(ImageFilter.GaussianBlur(1.5))
+        image.putalpha(mask)
+        alpha = np.asarray(mask)
+
+    rows = np.nonzero(alpha.max(axis=1) > 16)[0]
+    cols = np.nonzero(alpha.max(axis=0) > 16)[0]
+    if len(rows) == 0 or len(cols) == 0:
+        return image
+    return image.crop((cols[0], rows[0], cols[-1] + 1, rows[-1] + 1))
+
+
+def _text_color(background, box):
+    # Dark text on light regions, light text on dark ones
+    region = np.asarray(background.crop(box).convert("L"), dtype=np.float64)
+    if region.size and region.mean() > 140:
+        return (34, 34, 34), (255, 255, 255)
+    return (255, 255, 255), (34, 34, 34)
+
+
+def _draw_centered_text(canvas, text, top, font, max_width):
+    if not text:
+        return top
+    draw = ImageDraw.Draw(canvas)
+    # Shrink until the line fits the canvas width
+    while True:
+        left, upper, right, lower = draw.textbbox((0, 0), text, font=font)
+        if right - left <= max_width or font.size <= 12:
+            break
+        font = font.font_variant(size=int(font.size * 0.9))
+    width, height = right - left, lower - upper
+    x = (canvas.width - width) // 2 - left
+    fill, stroke = _text_color(canvas, (max(x, 0), top, min(x + width, canvas.width), top + height))
+    draw.text((x, top - upper), text, font=font, fill=fill,
+              stroke_width=max(1, font.size // 18), stroke_fill=stroke)
+    return top + height
+
+
+def _product_grid(count, width, area_height, margin):
+    # One row while slots stay at least MIN_SLOT_WIDTH wide, then wrap.
+    # Returns (columns, rows, slot_width, slot_height, row_gap); row gaps shrink
+    # so every row fits the product area.
+    per_row = max(1, (width - margin) // (int(width * MIN_SLOT_WIDTH) + margin))
+    columns = max(1, min(count, per_row))
+    rows = -(-max(count, 1) // columns)
+    row_gap = min(margin, area_height // (4 * rows))
+    slot_width = max(1, (width - margin * (columns + 1)) // columns)
+    slot_height = max(1, (area_height - row_gap * (rows - 1)) // rows)
+    return columns, rows, slot_width, slot_height, row_gap
+
+
+def composite_banner(background, products, main_text, sub_text):
+    # background: RGB image; products: list of PIL images. Returns PNG bytes.
+    canvas = background.copy().convert("RGBA")
+    width, height = canvas.size
+
+    # Products on a grid, scaled to share the product area evenly
+    margin = int(width * PRODUCT_MARGIN)
+    area_top = int(height * PRODUCT_AREA_TOP)
+    area_height = int(height * (PRODUCT_AREA_BOTTOM - PRODUCT_AREA_TOP))
+    columns, rows, slot_width, slot_height, row_gap = _product_grid(len(products), width, area_height, margin)
+
+    cutouts = []
+    for product in products:
+        # Shrink before cutting out, the mask filters dominate compositing time.
+        # A little headroom over the slot size keeps cropped subjects sharp.
+        product = product.copy()
+        product.thumbnail((int(slot_width * 1.25), int(slot_height * 1.25)), Image.BILINEAR)
+        cutouts.append(cut_out(product))
+
+    for i, product in enumerate(cutouts):
+        row, column = divmod(i, columns)
+        # A shorter last row is centred
+        in_row = min(columns, len(cutouts) - row * columns)
+        row_left = (width - in_row * slot_width - (in_row - 1) * margin) // 2
+        scale = min(slot_width / product.width, slot_height / product.height)
+        size = (max(1, int(product.width * scale)), max(1, int(product.height * scale)))
+        product = product.resize(size, Image.LANCZOS)
+        x = row_left + column * (slot_width + margin) + (slot_width - size[0]) // 2
+        # Bottom-aligned in the slot, last row on the bottom of the product area
+        y = area_top + area_height - (rows - row - 1) * (slot_height + row_gap) - size[1]
+
+        # Soft drop shadow from the product's own alpha
+        shadow = Image.new("RGBA", size, (0, 0, 0, 0))
+        shadow.putalpha(product.getchannel("A").point(lambda a: int(a * 0.35)))
+        shadow = shadow.filter(ImageFilter.GaussianBlur(max(2, size[0] // 40)))
+        offset = max(2, size[1] // 60)
+        canvas.alpha_composite(shadow, (x + offset, y + offset))
+        canvas.alpha_composite(product, (x, y))
+
+    max_text_width = int(width * 0.9)
+    top = int(height * TEXT_TOP)
+    top = _draw_centered_text(canvas, main_text, top, load_font(int(height * MAIN_TEXT_SIZE)), max_text_width)
+    top += int(height * 0.02)
+    _draw_centered_text(canvas, sub_text, top, load_font(int(height * SUB_TEXT_SIZE)), max_text_width)
+
+    buf = io.BytesIO()
+    canvas.convert("RGB").save(buf, format="PNG", compress_level=1)
+    return buf.getvalue()
+
+
+def run_composite(request, library, phash_index, history_store=None):
+    # Same contract as core.run_generation, composited locally from the library.
+    # request["tag"] must be one of core.TAG_PROMPTS.
+    if not request.get("images"):
+        return None, "画像をアップロードしてください。"
+    if not is_available():
+        return None, "高速モードに必要な日本語フォントが見つかりません（GIFT_FONT_PATH を設定してください）。高品質モードをご利用ください。"
+    tag = request.get("tag")
+    if tag not in core.TAG_PROMPTS:
+        return None, "高速モードではタグ（スタイル）を選択してください。"
+
+    template = request.get("template")
+    template_name = template["label"] if template and template.get("builtin") else None
+    background = library.get(tag, request.get("aspect_ratio"), template_name)
+    if background is None:
+        return None, "この組み合わせの背景がまだ用意されていません。高品質モードをご利用ください。"
+
+    started_at = time.monotonic()
+    try:
+        # Canonical assets are already downscaled, which keeps compositing fast
+        unique_images, _ = dedupe_images(request["images"], phash_index)
+        products = [Image.open(io.BytesIO(data)) for data, _, _ in unique_images]
+        image_data = composite_banner(background, products, request.get("main_text", ""), request.get("sub_text", ""))
+    except Exception as e:
+        return None, f"エラーが発生しました: {str(e)}"
+    result = {"image_data": image_data, "latency_ms": int((time.monotonic() - started_at) * 1000), "history_id": None}
+
+    if history_store is not None:
+        try:
+            result["history_id"] = history_store.add(
+                image_data,
+                main_text=request.get("main_text", ""),
+                sub_text=request.get("sub_text", ""),
+                prompt_style=request.get("prompt_style", ""),
+                template=template["label"] if template else None,
+                aspect_ratio=request["aspect_ratio"],
+                model=LOCAL_MODEL,
+                latency_ms=result["latency_ms"],
+                campaign=request.get("campaign"),
+                tag=tag,
+            )
+        except Exception as e:
+            print(f"Error saving history: {e}")
+    return result, None
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Pre-generate the style background library")
+    parser.add_argument("command", choices=["build"])
+    parser.add_argument("--model", default=core.DEFAULT_MODEL)
+    parser.add_argument("--tag", action="append", choices=list(core.TAG_PROMPTS), help="limit to these tags")
+    parser.add_argument("--aspect-ratio", action="append", choices=core.ASPECT_RATIOS, help="limit to these ratios")
+    parser.add_argument("--force", action="store_true", help="regenerate existing backgrounds")
+    args = parser.parse_args()
+
+    api_key = os.getenv("GOOGLE_API_KEY", "")
+    if not api_key:
+        parser.error("GOOGLE_API_KEY is not set")
+
+    failures = build_library(api_key, args.model, tags=args.tag, aspect_ratios=args.aspect_ratio, force=args.force)
+    raise SystemExit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import time
+
+import requests
+
+import core
+
+# Client for the headless generation service (see service.py).
+
+SUBMIT_TIMEOUT = 60
+LONG_POLL_SECONDS = 30
+JOB_TIMEOUT = core.REQUEST_TIMEOUT + 120
+
+
+def submit_job(service_url, request):
+    # Returns (job_id, None) or (None, error_message)
+    try:
+        response = requests.post(
+            f"{service_url.rstrip('/')}/jobs",
+            json=core.encode_request(request),
+            timeout=SUBMIT_TIMEOUT,
+        )
+    except requests.RequestException as e:
+        return None, f"生成サービスに接続できませんでした: {str(e)}"
+    if response.status_code == 503:
+        return None, "生成サービスが混み合っています。しばらくしてから再度お試しください。"
+    if response.status_code != 202:
+        return None, f"生成サービスエラー: {response.status_code}\n{response.text}"
+    return response.json()["id"], None
+
+
+def wait_for_job(service_url, job_id, timeout=JOB_TIMEOUT):
+    # Long-polls until the job finishes. Returns (job, None) or (None, error_message)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            response = requests.get(
+                f"{service_url.rstrip('/')}/jobs/{job_id}",
+                params={"wait": LONG_POLL_SECONDS},
+                timeout=LONG_POLL_SECONDS + 10,
+            )
+        except requests.RequestException as e:
+            return None, f"生成サービスに接続できませんでした: {str(e)}"
+        if response.status_code != 200:
+            return None, f"生成サービスエラー: {response.status_code}\n{response.text}"
+        job = response.json()
+        if job["status"] == "done":
+            return job, None
+        if job["status"] == "failed":
+            return None, job.get("error") or "画像の生成に失敗しました。"
+    return None, "生成がタイムアウトしました。"
+
+
+def fetch_job_image(service_url, job):
+    response = requests.get(f"{service_url.rstrip('/')}{job['image_url']}", timeout=SUBMIT_TIMEOUT)
+    response.raise_for_status()
+    return response.content
+
+
+def run_generation(service_url, request):
+    # Same contract as core.run_generation, executed by the service
+    job_id, error = submit_job(service_url, request)
+    if error:
+        return None, error
+    job, error = wait_for_job(service_url, job_id)
+    if error:
+        return None, error
+    try:
+        image_data = fetch_job_image(service_url, job)
+    except requests.RequestException as e:
+        return None, f"生成画像の取得に失敗しました: {str(e)}"
+    return {"image_data": image_data, "history_id": job.get("history_id")}, None
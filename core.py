@@ -0,0 +1,347 @@
+import os
+import io
+import json
+import base64
+import time
+
+import requests
+from PIL import Image
+
+import usage
+from image_dedup import dedupe_images
+
+# UI-free generation pipeline.
+# Shared by the Streamlit app (in-process) and the HTTP job service, so it must
+# not touch Streamlit widgets or session state.
+
+DEFAULT_MODEL = "gemini-3-pro-image-preview"
+API_URL = "https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent?key={key}"
+REQUEST_TIMEOUT = 300
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+# Usage accounting groups every uploaded reference design under this label
+CUSTOM_TEMPLATE_LABEL = "参照デザイン（アップロード）"
+ASPECT_RATIOS = ["1:1", "16:9", "9:16", "4:3", "3:4"]
+
+# Style presets offered as tag buttons in the UI
+TAG_PROMPTS = {
+    "パステルカラー": "パステルカラーを基調とした、ふんわりと優しい雰囲気のデザイン。明るく柔らかい光の演出を加え、可愛らしさと幸福感を表現してください。",
+    "高級感": "黒やゴールド、深い色合いを使用した、シックで高級感のあるデザイン。洗練されたフォントとレイアウトで、プレミアムなギフトであることを強調してください。",
+    "シンプル": "余計な装飾を削ぎ落とした、ミニマルで洗練されたデザイン。余白を活かし、商品画像とテキストが際立つように清潔感のある構成にしてください。",
+    "ポップ": "鮮やかな色使いと元気な印象を与えるポップなデザイン。動きのあるレイアウトや幾何学模様を取り入れ、楽しさとワクワク感を演出してください。",
+    "和風": "和紙の質感や伝統的な和柄（麻の葉、青海波など）を取り入れた、落ち着きのある和風デザイン。上品で奥ゆかしい雰囲気を表現してください。",
+    "季節感（冬）": "雪の結晶やキラキラとした光、寒色系のカラーパレットを使用した冬らしいデザイン。温かみのあるギフトとしての魅力を引き立てる、幻想的な雰囲気にしてください。"
+}
+
+
+def load_template_file(name):
+    # Templates are referenced by file name only, never by arbitrary path
+    if not name or os.path.basename(name) != name:
+        return None
+    path = os.path.join(TEMPLATE_DIR, name)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        data = f.read()
+    ext = os.path.splitext(name)[1].lower()
+    mime_type = "image/png" if ext == ".png" else "image/jpeg"
+    return {"label": name, "data": data, "mime_type": mime_type, "builtin": True}
+
+
+def build_prompt(main_text, sub_text, prompt_style, has_template=False, modification_instruction=""):
+    base_prompt = f"""
+        Create a high-quality, premium gift selection image.
+
+        Input Images: Use these product images as the main subjects.
+
+        Text Content:
+        - Main Text: "{main_text}" (Make this prominent and elegant)
+        - Sub Text: "{sub_text}" (Smaller, complementary text)
+
+        Style/Atmosphere: {prompt_style}
+
+        Requirements:
+        - Professional product photography style.
+        - If multiple images are provided, arrange them tastefully.
+        - Add a "Choice" or "Gift" theme background.
+        - Make it look like a high-end e-commerce banner.
+        - Ensure text is legible and integrated into the design.
+        """
+
+    if has_template:
+        base_prompt += "\n\nReference Design: Please use the provided reference image as a layout and style guide."
+
+    if modification_instruction:
+        base_prompt += f"\n\nMODIFICATION REQUEST: {modification_instruction}\nPlease regenerate the image applying these changes while keeping the original intent."
+
+    return base_prompt
+
+
+def build_payload(prompt, images, aspect_ratio, template=None):
+    # images: list of (bytes, mime_type); template: {"data", "mime_type"} or None
+    contents_parts = [{"text": prompt}]
+
+    if template:
+        contents_parts.append({
+            "inline_data": {
+                "mime_type": template["mime_type"],
+                "data": base64.b64encode(template["data"]).decode('utf-8')
+            }
+        })
+
+    for bytes_data, mime_type in images:
+        contents_parts.append({
+            "inline_data": {
+                "mime_type": mime_type,
+                "data": base64.b64encode(bytes_data).decode('utf-8')
+            }
+        })
+
+    return {
+        "contents": [
+            {
+                "parts": contents_parts
+            }
+        ],
+        "generationConfig": {
+            "responseModalities": ["IMAGE"],
+            "imageConfig": {
+                "aspectRatio": aspect_ratio
+            }
+        }
+    }
+
+
+def _record_usage(usage_store, context, model_name, payload, body, latency_ms, response=None, result=None, image=None):
+    # Never lets accounting failures affect generation
+    if usage_store is None:
+        return
+    try:
+        context = context or {}
+        metadata = (result or {}).get("usageMetadata", {})
+        candidates = (result or {}).get("candidates", [])
+        image_count = context.get("image_count")
+        if image_count is None:
+            image_count = sum(1 for part in payload["contents"][0]["parts"] if "inline_data" in part)
+        # Image and text output are priced differently; thinking tokens count as text
+        text_output_tokens = metadata.get("thoughtsTokenCount", 0)
+        image_output_tokens = 0
+        details = metadata.get("candidatesTokensDetails")
+        if details:
+            for detail in details:
+                if detail.get("modality") == "IMAGE":
+                    image_output_tokens += detail.get("tokenCount", 0)
+                else:
+                    text_output_tokens += detail.get("tokenCount", 0)
+        else:
+            # Only images are requested, so without details all candidates are image output
+            image_output_tokens = metadata.get("candidatesTokenCount", 0)
+        usage_store.record(
+            model=model_name,
+            latency_ms=latency_ms,
+            image_count=image_count,
+            payload_bytes=len(body),
+            prompt_tokens=metadata.get("promptTokenCount", 0),
+            text_output_tokens=text_output_tokens,
+            image_output_tokens=image_output_tokens,
+            total_tokens=metadata.get("totalTokenCount", 0),
+            output_size=usage.output_size_label(*image.size) if image is not None else None,
+            status_code=response.status_code if response is not None else None,
+            finish_reason=candidates[0].get("finishReason") if candidates else None,
+            ok=image is not None,
+            template=context.get("template"),
+            tag=context.get("tag"),
+            aspect_ratio=payload["generationConfig"]["imageConfig"]["aspectRatio"],
+            source=context.get("source"),
+        )
+    except Exception as e:
+        print(f"Error recording usage: {e}")
+
+
+def call_model(api_key, model_name, payload, usage_store=None, context=None):
+    # Returns ({"image_data": png_bytes, "latency_ms": int}, None) or (None, error_message).
+    # Every call, successful or not, is recorded to usage_store when given;
+    # context supplies the template, tag, source and product image_count.
+    url = API_URL.format(model=model_name, key=api_key)
+    headers = {
+        "Content-Type": "application/json"
+    }
+    body = json.dumps(payload)
+
+    started_at = time.monotonic()
+    try:
+        response = requests.post(url, headers=headers, data=body, timeout=REQUEST_TIMEOUT)
+    except requests.RequestException as e:
+        latency_ms = int((time.monotonic() - started_at) * 1000)
+        _record_usage(usage_store, context, model_name, payload, body, latency_ms)
+        return None, f"エラーが発生しました: {str(e)}"
+    latency_ms = int((time.monotonic() - started_at) * 1000)
+
+    if response.status_code != 200:
+        _record_usage(usage_store, context, model_name, payload, body, latency_ms, response)
+        if response.status_code == 429:
+            return None, "APIエラー: 429 (利用枠超過)。サイドバーでモデルIDを変更してみてください。"
+        return None, f"APIエラー: {response.status_code}\n{response.text}"
+
+    result = None
+    image = None
+    try:
+        result = response.json()
+        candidates = result.get("candidates", [])
+        if not candidates:
+            return None, "生成候補が見つかりませんでした。"
+
+        parts = candidates[0].get("content", {}).get("parts", [])
+        image_part = None
+        for part in parts:
+            if "inlineData" in part:
+                image_part = part["inlineData"]
+                break
+        if not image_part:
+            return None, "画像が生成されませんでした。レスポンスに画像データが含まれていません。"
+
+        # Normalize to PNG so history and downloads always get the same format
+        image = Image.open(io.BytesIO(base64.b64decode(image_part["data"])))
+        buf = io.BytesIO()
+        image.save(buf, format="PNG")
+        return {"image_data": buf.getvalue(), "latency_ms": latency_ms}, None
+    except Exception as parse_error:
+        image = None
+        return None, f"レスポンスの解析に失敗しました: {str(parse_error)}"
+    finally:
+        _record_usage(usage_store, context, model_name, payload, body, latency_ms, response, result, image)
+
+
+def run_generation(request, api_key, phash_index, history_store=None, usage_store=None, source=None):
+    # Full pipeline for one request: dedupe uploads, call the model, record history.
+    # request keys: images [(bytes, name)], main_text, sub_text, prompt_style,
+    # aspect_ratio, model, template ({"label", "data", "mime_type"} or None),
+    # modification_instruction, campaign, tag
+    if not request.get("images"):
+        return None, "画像をアップロードしてください。"
+    if request.get("aspect_ratio") not in ASPECT_RATIOS:
+        return None, f"未対応のアスペクト比です: {request.get('aspect_ratio')}"
+
+    model_name = request.get("model") or DEFAULT_MODEL
+    template = request.get("template")
+
+    try:
+        # Near-duplicate uploads are sent once, using their canonical asset
+        unique_images, _ = dedupe_images(request["images"], phash_index)
+        prompt = build_prompt(
+            request.get("main_text", ""),
+            request.get("sub_text", ""),
+            request.get("prompt_style", ""),
+            has_template=template is not None,
+            modification_instruction=request.get("modification_instruction", ""),
+        )
+        payload = build_payload(
+            prompt,
+            [(data, mime_type) for data, mime_type, _ in unique_images],
+            request["aspect_ratio"],
+            template,
+        )
+    except Exception as e:
+        return None, f"エラーが発生しました: {str(e)}"
+
+    usage_template = None
+    if template:
+        usage_template = template["label"] if template.get("builtin") else CUSTOM_TEMPLATE_LABEL
+    context = {
+        "image_count": len(unique_images),
+        "template": usage_template,
+        "tag": request.get("tag"),
+        "source": source,
+    }
+    result, error = call_model(api_key, model_name, payload, usage_store, context)
+    if error:
+        return None, error
+
+    result["history_id"] = None
+    if history_store is not None:
+        # Keep a persistent copy so past results can be reopened without API calls
+        try:
+            result["history_id"] = history_store.add(
+                result["image_data"],
+                main_text=request.get("main_text", ""),
+                sub_text=request.get("sub_text", ""),
+                prompt_style=request.get("prompt_style", ""),
+                template=template["label"] if template else None,
+                aspect_ratio=request["aspect_ratio"],
+                model=model_name,
+                latency_ms=result["latency_ms"],
+                campaign=request.get("campaign"),
+                tag=request.get("tag"),
+            )
+        except Exception as e:
+            print(f"Error saving history: {e}")
+    return result, None
+
+
+# Wire format used by the HTTP job service: the same request, with image bytes
+# base64-encoded and built-in templates referenced by file name.
+
+def encode_request(request):
+    encoded = {key: value for key, value in request.items() if key not in ("images", "template")}
+    encoded["images"] = [
+        {"name": name, "data": base64.b64encode(data).decode('utf-8')}
+        for data, name in request.get("images", [])
+    ]
+    template = request.get("template")
+    encoded["template"] = None
+    encoded["reference_image"] = None
+    if template and template.get("builtin"):
+        encoded["template"] = template["label"]
+    elif template:
+        encoded["reference_image"] = {
+            "name": template["label"],
+            "mime_type": template["mime_type"],
+            "data": base64.b64encode(template["data"]).decode('utf-8'),
+        }
+    return encoded
+
+
+TEXT_FIELDS = ("main_text", "sub_text", "prompt_style", "aspect_ratio", "model",
+               "modification_instruction", "campaign", "tag", "mode", "template")
+
+
+def _decode_image(image, default_name):
+    if not isinstance(image, dict):
+        raise ValueError("each image must be an object")
+    name = image.get("name", default_name)
+    mime_type = image.get("mime_type", "image/png")
+    if not isinstance(image.get("data"), str) or not isinstance(name, str) or not isinstance(mime_type, str):
+        raise ValueError("image data, name and mime_type must be strings")
+    try:
+        return base64.b64decode(image["data"], validate=True), name, mime_type
+    except ValueError as e:
+        raise ValueError(f"invalid image data: {e}")
+
+
+def decode_request(encoded):
+    # Raises ValueError on malformed input, including JSON of the wrong shape
+    if not isinstance(encoded, dict):
+        raise ValueError("request must be an object")
+    for field in TEXT_FIELDS:
+        if encoded.get(field) is not None and not isinstance(encoded[field], str):
+            raise ValueError(f"{field} must be a string")
+    request = {key: value for key, value in encoded.items() if key not in ("images", "template", "reference_image")}
+
+    images = encoded.get("images")
+    if not isinstance(images, list):
+        raise ValueError("images must be a list")
+    request["images"] = []
+    for i, image in enumerate(images):
+        data, name, _ = _decode_image(image, f"image_{i}")
+        request["images"].append((data, name))
+
+    request["template"] = None
+    if encoded.get("template"):
+        template = load_template_file(encoded["template"])
+        if template is None:
+            raise ValueError(f"unknown template: {encoded['template']}")
+        request["template"] = template
+    elif encoded.get("reference_image"):
+        data, name, mime_type = _decode_image(encoded["reference_image"], "reference")
+        request["template"] = {"label": name, "data": data, "mime_type": mime_type}
+    return request
@@ -0,0 +1,205 @@
+import os
+import io
+import hashlib
+import sqlite3
+import threading
+import time
+
+from PIL import Image
+
+# Persistent generation history.
+# Metadata lives in SQLite; images are stored once on disk, addressed by the
+# SHA-256 of their PNG bytes, with a small JPEG thumbnail for gallery pages.
+
+CACHE_DIR = os.getenv("GIFT_CACHE_DIR", ".cache")
+HISTORY_DB_PATH = os.path.join(CACHE_DIR, "history.db")
+HISTORY_IMAGE_DIR = os.path.join(CACHE_DIR, "history")
+
+THUMBNAIL_SIZE = 320
+THUMBNAIL_QUALITY = 80
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS generations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at REAL NOT NULL,
+    main_text TEXT NOT NULL DEFAULT '',
+    sub_text TEXT NOT NULL DEFAULT '',
+    prompt_style TEXT NOT NULL DEFAULT '',
+    template TEXT,
+    aspect_ratio TEXT,
+    model TEXT,
+    latency_ms INTEGER,
+    campaign TEXT,
+    tag TEXT,
+    image_sha TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_generations_created ON generations (created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_generations_campaign ON generations (campaign, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_generations_tag ON generations (tag, created_at DESC);
+"""
+
+# Full-text index over the text fields, kept in sync with triggers.
+# The trigram tokenizer handles Japanese text, which has no word separators.
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS generations_fts USING fts5 (
+    main_text, sub_text, prompt_style,
+    content='generations', content_rowid='id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS generations_ai AFTER INSERT ON generations BEGIN
+    INSERT INTO generations_fts (rowid, main_text, sub_text, prompt_style)
+    VALUES (new.id, new.main_text, new.sub_text, new.prompt_style);
+END;
+CREATE TRIGGER IF NOT EXISTS generations_ad AFTER DELETE ON generations BEGIN
+    INSERT INTO generations_fts (generations_fts, rowid, main_text, sub_text, prompt_style)
+    VALUES ('delete', old.id, old.main_text, old.sub_text, old.prompt_style);
+END;
+"""
+
+LIST_COLUMNS = "id, created_at, main_text, sub_text, template, aspect_ratio, model, latency_ms, campaign, tag, image_sha"
+
+
+class HistoryStore:
+    def __init__(self, db_path=HISTORY_DB_PATH, image_dir=HISTORY_IMAGE_DIR):
+        self.db_path = db_path
+        self.image_dir = image_dir
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            try:
+                conn.executescript(FTS_SCHEMA)
+                self.has_fts = True
+            except sqlite3.OperationalError:
+                # SQLite built without FTS5 or the trigram tokenizer, fall back to LIKE
+                self.has_fts = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _image_path(self, image_sha):
+        return os.path.join(self.image_dir, image_sha[:2], image_sha + ".png")
+
+    def _thumbnail_path(self, image_sha):
+        return os.path.join(self.image_dir, image_sha[:2], image_sha + "_thumb.jpg")
+
+    def _store_image(self, image_bytes):
+        image_sha = hashlib.sha256(image_bytes).hexdigest()
+        image_path = self._image_path(image_sha)
+        if os.path.exists(image_path):
+            return image_sha
+
+        os.makedirs(os.path.dirname(image_path), exist_ok=True)
+        thumb = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+        thumb.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.LANCZOS)
+        thumb.save(self._thumbnail_path(image_sha), format="JPEG", quality=THUMBNAIL_QUALITY)
+
+        # Write the full image last so its presence means the entry is complete
+        tmp_path = image_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(image_bytes)
+        os.replace(tmp_path, image_path)
+        return image_sha
+
+    def add(self, image_bytes, main_text="", sub_text="", prompt_style="", template=None,
+            aspect_ratio=None, model=None, latency_ms=None, campaign=None, tag=None):
+        image_sha = self._store_image(image_bytes)
+        with self._lock, self._connect() as conn:
+            cursor = conn.execute(
+                "INSERT INTO generations (created_at, main_text, sub_text, prompt_style, template,"
+                " aspect_ratio, model, latency_ms, campaign, tag, image_sha)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), main_text or "", sub_text or "", prompt_style or "", template,
+                 aspect_ratio, model, latency_ms, campaign or None, tag, image_sha),
+            )
+            return cursor.lastrowid
+
+    def _filters(self, query=None, campaign=None, tag=None, date_from=None, date_to=None):
+        clauses = []
+        params = []
+        if query:
+            if self.has_fts and len(query) >= 3:
+                # Quote the query so user input is matched as a literal phrase
+                clauses.append("id IN (SELECT rowid FROM generations_fts WHERE generations_fts MATCH ?)")
+                params.append('"' + query.replace('"', '""') + '"')
+            else:
+                # Trigram FTS needs at least three characters
+                pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+                clauses.append(
+                    "(main_text LIKE ? ESCAPE '\\' OR sub_text LIKE ? ESCAPE '\\' OR prompt_style LIKE ? ESCAPE '\\')"
+                )
+                params.extend([pattern] * 3)
+        if campaign:
+            clauses.append("campaign = ?")
+            params.append(campaign)
+        if tag:
+            clauses.append("tag = ?")
+            params.append(tag)
+        if date_from is not None:
+            clauses.append("created_at >= ?")
+            params.append(date_from)
+        if date_to is not None:
+            clauses.append("created_at < ?")
+            params.append(date_to)
+        return clauses, params
+
+    def list_entries(self, query=None, campaign=None, tag=None, date_from=None, date_to=None,
+                     cursor=None, limit=24):
+        # Keyset pagination: `cursor` is the (created_at, id) of the last entry on
+        # the previous page, so deep pages cost the same as the first one.
+        # Returns (entries, next_cursor); next_cursor is None on the last page.
+        clauses, params = self._filters(query, campaign, tag, date_from, date_to)
+        if cursor is not None:
+            clauses.append("(created_at, id) < (?, ?)")
+            params.extend(cursor)
+        where = (" WHERE " + " AND ".join(clauses)) if clauses else ""
+        sql = (f"SELECT {LIST_COLUMNS} FROM generations{where}"
+               " ORDER BY created_at DESC, id DESC LIMIT ?")
+        with self._connect() as conn:
+            rows = [dict(row) for row in conn.execute(sql, params + [limit + 1])]
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = (rows[-1]["created_at"], rows[-1]["id"])
+        return rows, next_cursor
+
+    def count(self, query=None, campaign=None, tag=None, date_from=None, date_to=None):
+        clauses, params = self._filters(query, campaign, tag, date_from, date_to)
+        where = (" WHERE " + " AND ".join(clauses)) if clauses else ""
+        with self._connect() as conn:
+            return conn.execute(f"SELECT COUNT(*) FROM generations{where}", params).fetchone()[0]
+
+    def get(self, entry_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM generations WHERE id = ?", (entry_id,)).fetchone()
+        return dict(row) if row else None
+
+    def campaigns(self):
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT DISTINCT campaign FROM generations WHERE campaign IS NOT NULL ORDER BY campaign"
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def tags(self):
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT DISTINCT tag FROM generations WHERE tag IS NOT NULL ORDER BY tag"
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def load_thumbnail(self, image_sha):
+        path = self._thumbnail_path(image_sha)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def load_image(self, image_sha):
+        path = self._image_path(image_sha)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read()
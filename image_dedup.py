@@ -0,0 +1,347 @@
+import os
+import io
+import uuid
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+# Perceptual-hash index for product uploads.
+# Near-duplicate uploads (same shot re-exported at another JPEG quality or size)
+# are mapped onto one canonical preprocessed asset, so they are sent to the model
+# once per request and produce identical bytes across sessions.
+# The index lives in SQLite so the app and any number of service workers share it.
+
+CACHE_DIR = os.getenv("GIFT_CACHE_DIR", ".cache")
+ASSET_DIR = os.path.join(CACHE_DIR, "assets")
+INDEX_PATH = os.path.join(CACHE_DIR, "phash_index.db")
+
+# Max hamming distance (out of 64 bits) for two images to count as the same shot.
+# Both hashes must agree: pHash is robust to re-compression, aHash guards
+# against pHash collisions on flat, low-texture images.
+PHASH_THRESHOLD = 8
+AHASH_THRESHOLD = 10
+
+# pHash/aHash are grayscale and coarse, so candidates are confirmed against a small
+# RGB thumbnail: colour variants and label-text changes differ strongly in a few
+# cells, while re-exports stay within a few levels everywhere.
+THUMB_SIZE = 32
+THUMB_MEAN_THRESHOLD = 6
+THUMB_MAX_THRESHOLD = 28
+
+# Canonical assets are downscaled to this long side before being stored.
+MAX_ASSET_SIDE = 1536
+JPEG_QUALITY = 90
+
+# Number of recent uploads whose canonical result is kept in memory
+MEMO_SIZE = 64
+
+HASH_SIZE = 8
+DCT_SIZE = 32
+
+# Hashes are 64-bit hex strings; version increases on every insert or upgrade
+# so each process can cheaply pick up the others' changes.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS assets (
+    key TEXT PRIMARY KEY,
+    phash TEXT NOT NULL,
+    ahash TEXT NOT NULL,
+    asset TEXT NOT NULL,
+    mime TEXT NOT NULL,
+    pixels INTEGER NOT NULL,
+    thumbnail BLOB NOT NULL,
+    version INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_assets_version ON assets (version);
+"""
+
+
+def _dct_matrix(n):
+    # Orthonormal DCT-II basis, so the 2D DCT is C @ X @ C.T
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    c = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    c[0, :] = np.sqrt(1.0 / n)
+    return c
+
+
+_DCT = _dct_matrix(DCT_SIZE)
+
+
+def _flatten(image):
+    # Flatten transparency onto white so cut-out PNGs hash like their JPEG exports
+    if image.mode in ("RGBA", "LA", "P"):
+        image = image.convert("RGBA")
+        background = Image.new("RGBA", image.size, (255, 255, 255, 255))
+        image = Image.alpha_composite(background, image)
+    return image
+
+
+def _grayscale_array(image, size):
+    gray = _flatten(image).convert("L").resize((size, size), Image.LANCZOS)
+    return np.asarray(gray, dtype=np.float64)
+
+
+def color_thumbnail(image):
+    # uint8 RGB array used to confirm perceptual-hash matches
+    thumb = _flatten(image).convert("RGB").resize((THUMB_SIZE, THUMB_SIZE), Image.BOX)
+    return np.asarray(thumb, dtype=np.uint8)
+
+
+def thumbnails_match(a, b):
+    diff = np.abs(a.astype(np.int16) - b.astype(np.int16))
+    return diff.mean() <= THUMB_MEAN_THRESHOLD and diff.max() <= THUMB_MAX_THRESHOLD
+
+
+def _bits_to_int(bits):
+    value = 0
+    for bit in bits.flatten():
+        value = (value << 1) | int(bit)
+    return value
+
+
+def average_hash(image):
+    pixels = _grayscale_array(image, HASH_SIZE)
+    return _bits_to_int(pixels > pixels.mean())
+
+
+def phash(image):
+    pixels = _grayscale_array(image, DCT_SIZE)
+    coeffs = (_DCT @ pixels @ _DCT.T)[:HASH_SIZE, :HASH_SIZE]
+    # Exclude the DC term from the median, it only encodes overall brightness
+    median = np.median(coeffs.flatten()[1:])
+    return _bits_to_int(coeffs > median)
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+def _popcount64(values):
+    # Vectorised popcount over a uint64 array
+    as_bytes = values.view(np.uint8).reshape(-1, 8)
+    return np.unpackbits(as_bytes, axis=1).sum(axis=1)
+
+
+def _asset_pixels(image):
+    # Pixel count the image will have once preprocessed
+    scale = min(1.0, MAX_ASSET_SIDE / max(image.size))
+    return int(image.width * scale) * int(image.height * scale)
+
+
+def preprocess_image(image):
+    # Downscale and re-encode so every near-duplicate maps to the same bytes.
+    # Transparency is kept (PNG) since cut-out products rely on it.
+    image = image.copy()
+    image.thumbnail((MAX_ASSET_SIDE, MAX_ASSET_SIDE), Image.LANCZOS)
+    buf = io.BytesIO()
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        image.convert("RGBA").save(buf, format="PNG", optimize=True)
+        return buf.getvalue(), "image/png"
+    image.convert("RGB").save(buf, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+    return buf.getvalue(), "image/jpeg"
+
+
+class PerceptualHashIndex:
+    def __init__(self, index_path=INDEX_PATH, asset_dir=ASSET_DIR):
+        self.index_path = index_path
+        self.asset_dir = asset_dir
+        self._lock = threading.Lock()
+        # In-memory copy of the assets table for vectorised search.
+        # Each entry: {"key", "phash", "ahash", "asset", "mime", "pixels", "thumbnail"};
+        # "key" stays fixed when the asset is upgraded.
+        self._entries = []
+        self._positions = {}
+        self._version = 0
+        self._phashes = np.zeros(0, dtype=np.uint64)
+        self._ahashes = np.zeros(0, dtype=np.uint64)
+        # Exact-bytes memo (digest -> entry key) so Streamlit reruns don't
+        # re-decode the same upload; the entry's current asset is read on a hit
+        self._memo = OrderedDict()
+        os.makedirs(os.path.dirname(index_path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            self._refresh(conn)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.index_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _refresh(self, conn):
+        # Picks up entries added or upgraded by other processes since the last refresh
+        rows = conn.execute(
+            "SELECT * FROM assets WHERE version > ? ORDER BY version", (self._version,)
+        ).fetchall()
+        if not rows:
+            return
+        for row in rows:
+            entry = dict(row)
+            entry["thumbnail"] = np.frombuffer(row["thumbnail"], dtype=np.uint8).reshape(THUMB_SIZE, THUMB_SIZE, 3)
+            if entry["key"] in self._positions:
+                self._entries[self._positions[entry["key"]]] = entry
+            else:
+                self._positions[entry["key"]] = len(self._entries)
+                self._entries.append(entry)
+            self._version = max(self._version, entry["version"])
+        self._phashes = np.array([int(e["phash"], 16) for e in self._entries], dtype=np.uint64)
+        self._ahashes = np.array([int(e["ahash"], 16) for e in self._entries], dtype=np.uint64)
+
+    def _find(self, p_hash, a_hash, thumbnail):
+        # Closest hash candidate whose RGB thumbnail also matches, or None
+        if not self._entries:
+            return None
+        p_dist = _popcount64(self._phashes ^ np.uint64(p_hash))
+        a_dist = _popcount64(self._ahashes ^ np.uint64(a_hash))
+        matches = np.nonzero((p_dist <= PHASH_THRESHOLD) & (a_dist <= AHASH_THRESHOLD))[0]
+        for i in matches[np.argsort(p_dist[matches], kind="stable")]:
+            entry = self._entries[i]
+            if thumbnails_match(entry["thumbnail"], thumbnail):
+                return entry
+        return None
+
+    def _write_asset(self, image):
+        data, mime_type = preprocess_image(image)
+        ext = ".png" if mime_type == "image/png" else ".jpg"
+        asset_name = hashlib.sha256(data).hexdigest() + ext
+        os.makedirs(self.asset_dir, exist_ok=True)
+        asset_path = os.path.join(self.asset_dir, asset_name)
+        if not os.path.exists(asset_path):
+            # Unique tmp name, other processes may be writing the same asset
+            tmp_path = f"{asset_path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, asset_path)
+        return data, mime_type, asset_name
+
+    def _remove_asset(self, asset_name):
+        try:
+            os.remove(os.path.join(self.asset_dir, asset_name))
+        except OSError:
+            pass
+
+    def _remember(self, digest, key):
+        self._memo[digest] = key
+        if len(self._memo) > MEMO_SIZE:
+            self._memo.popitem(last=False)
+
+    def _read_asset(self, entry):
+        with open(os.path.join(self.asset_dir, entry["asset"]), "rb") as f:
+            return f.read()
+
+    def _lookup(self, entry, image):
+        # Canonical result for `image` if `entry` already covers it, else None
+        if entry is None or _asset_pixels(image) > entry["pixels"]:
+            return None
+        try:
+            return self._read_asset(entry), entry["mime"], entry["key"]
+        except OSError:
+            # Upgraded by another process, or removed from the cache
+            return None
+
+    def canonicalize(self, image_bytes):
+        # Returns (canonical_bytes, mime_type, key) for an upload.
+        # Near-duplicates of a previously seen image resolve to that image's asset
+        # and share its key; a larger upload replaces the stored asset.
+        digest = hashlib.sha256(image_bytes).hexdigest()
+        with self._lock:
+            key = self._memo.get(digest)
+            if key is not None:
+                with self._connect() as conn:
+                    self._refresh(conn)
+                entry = self._entries[self._positions[key]]
+                try:
+                    result = (self._read_asset(entry), entry["mime"], entry["key"])
+                    self._memo.move_to_end(digest)
+                    return result
+                except OSError:
+                    del self._memo[digest]
+
+        image = Image.open(io.BytesIO(image_bytes))
+        image.load()
+        p_hash = phash(image)
+        a_hash = average_hash(image)
+        thumbnail = color_thumbnail(image)
+
+        with self._lock:
+            conn = self._connect()
+            try:
+                # Known shots are resolved without taking the write lock
+                self._refresh(conn)
+                result = self._lookup(self._find(p_hash, a_hash, thumbnail), image)
+                if result is not None:
+                    self._remember(digest, result[2])
+                    return result
+
+                # Look again under the write lock, another process may have just added it
+                conn.execute("BEGIN IMMEDIATE")
+                self._refresh(conn)
+                entry = self._find(p_hash, a_hash, thumbnail)
+                result = self._lookup(entry, image)
+                if result is not None:
+                    conn.execute("ROLLBACK")
+                    self._remember(digest, result[2])
+                    return result
+
+                data, mime_type, asset_name = self._write_asset(image)
+                key = entry["key"] if entry is not None else asset_name
+                conn.execute(
+                    "INSERT INTO assets (key, phash, ahash, asset, mime, pixels, thumbnail, version)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, (SELECT COALESCE(MAX(version), 0) + 1 FROM assets))"
+                    " ON CONFLICT (key) DO UPDATE SET phash = excluded.phash, ahash = excluded.ahash,"
+                    " asset = excluded.asset, mime = excluded.mime, pixels = excluded.pixels,"
+                    " thumbnail = excluded.thumbnail, version = excluded.version",
+                    (key, f"{p_hash:016x}", f"{a_hash:016x}", asset_name, mime_type,
+                     _asset_pixels(image), thumbnail.tobytes()),
+                )
+                conn.execute("COMMIT")
+                self._refresh(conn)
+            finally:
+                conn.close()
+
+            if entry is not None and entry["asset"] != asset_name:
+                # Higher-resolution upload of a known shot; other processes
+                # re-read the index when the old file is gone
+                self._remove_asset(entry["asset"])
+            self._remember(digest, key)
+            return data, mime_type, key
+
+
+def _pixel_count(data):
+    # Reads the header only
+    width, height = Image.open(io.BytesIO(data)).size
+    return width * height
+
+
+def dedupe_images(images, index):
+    # Canonicalizes every image and drops near-duplicates within the request.
+    # images: [(bytes, name), ...]
+    # Returns ([(bytes, mime_type, name), ...], [names of skipped duplicates])
+    unique = []
+    duplicates = []
+    positions = {}
+    for image_bytes, name in images:
+        data, mime_type, key = index.canonicalize(image_bytes)
+        if key in positions:
+            # A later, larger upload may have upgraded the canonical asset
+            position = positions[key]
+            if _pixel_count(data) > _pixel_count(unique[position][0]):
+                unique[position] = (data, mime_type, unique[position][2])
+            duplicates.append(name)
+            continue
+        positions[key] = len(unique)
+        unique.append((data, mime_type, name))
+    return unique, duplicates
+
+
+def dedupe_uploads(files, index):
+    # Same as dedupe_images, for Streamlit UploadedFile objects
+    images = []
+    for file in files:
+        file.seek(0)
+        images.append((file.getvalue(), file.name))
+    return dedupe_images(images, index)
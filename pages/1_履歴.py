@@ -0,0 +1,149 @@
+import streamlit as st
+from PIL import Image
+import io
+import datetime
+
+from history import HistoryStore
+
+PAGE_SIZE = 24
+GRID_COLUMNS = 4
+
+st.set_page_config(
+    page_title="Gift Image Creator - 履歴",
+    page_icon="🎁",
+    layout="wide",
+    initial_sidebar_state="collapsed"
+)
+
+@st.cache_resource
+def get_history_store():
+    return HistoryStore()
+
+store = get_history_store()
+
+# Initialize session state
+if "history_cursors" not in st.session_state:
+    # Stack of keyset cursors, one per visited page (None = first page)
+    st.session_state.history_cursors = [None]
+if "history_filters" not in st.session_state:
+    st.session_state.history_filters = None
+if "history_selected_id" not in st.session_state:
+    st.session_state.history_selected_id = None
+
+st.page_link("app.py", label="作成画面に戻る", icon="🎁")
+st.markdown("## 生成履歴")
+
+# Detail view: the full image is only read from disk here, never from the API
+if st.session_state.history_selected_id is not None:
+    entry = store.get(st.session_state.history_selected_id)
+    image_bytes = store.load_image(entry["image_sha"]) if entry else None
+    if not image_bytes:
+        st.error("画像が見つかりませんでした。")
+    else:
+        col_image, col_meta = st.columns([2, 1])
+        with col_image:
+            st.image(image_bytes, use_container_width=True)
+        with col_meta:
+            created = datetime.datetime.fromtimestamp(entry["created_at"]).strftime("%Y-%m-%d %H:%M")
+            st.markdown(f"**メインテキスト**: {entry['main_text']}")
+            st.markdown(f"**サブテキスト**: {entry['sub_text']}")
+            st.markdown(f"**作成日時**: {created}")
+            st.markdown(f"**見本デザイン**: {entry['template'] or '指定なし'}")
+            st.markdown(f"**アスペクト比**: {entry['aspect_ratio']}")
+            st.markdown(f"**モデル**: {entry['model']}")
+            if entry["latency_ms"] is not None:
+                st.markdown(f"**生成時間**: {entry['latency_ms'] / 1000:.1f}秒")
+            if entry["campaign"]:
+                st.markdown(f"**キャンペーン**: {entry['campaign']}")
+            if entry["tag"]:
+                st.markdown(f"**タグ**: {entry['tag']}")
+            with st.expander("AIへの指示"):
+                st.write(entry["prompt_style"])
+
+            st.download_button(
+                label="画像をダウンロード",
+                data=image_bytes,
+                file_name=f"gift_image_{entry['id']}.png",
+                mime="image/png",
+                use_container_width=True
+            )
+            if st.button("作成画面で開く", use_container_width=True):
+                # Load into the same session state the creator page uses
+                st.session_state.generated_image = Image.open(io.BytesIO(image_bytes))
+                st.session_state.generated_image_data = image_bytes
+                st.switch_page("app.py")
+
+    if st.button("一覧に戻る"):
+        st.session_state.history_selected_id = None
+        st.rerun()
+    st.stop()
+
+# Filters
+col_query, col_campaign, col_tag, col_date = st.columns([3, 2, 2, 2])
+with col_query:
+    query = st.text_input("キーワード", placeholder="メインテキスト・サブテキスト・指示から検索")
+with col_campaign:
+    campaign = st.selectbox("キャンペーン", options=["すべて"] + store.campaigns())
+with col_tag:
+    tag = st.selectbox("タグ", options=["すべて"] + store.tags())
+with col_date:
+    date_range = st.date_input("期間", value=())
+
+date_from = None
+date_to = None
+if len(date_range) >= 1:
+    date_from = datetime.datetime.combine(date_range[0], datetime.time.min).timestamp()
+if len(date_range) == 2:
+    date_to = datetime.datetime.combine(date_range[1] + datetime.timedelta(days=1), datetime.time.min).timestamp()
+
+filters = {
+    "query": query.strip() or None,
+    "campaign": None if campaign == "すべて" else campaign,
+    "tag": None if tag == "すべて" else tag,
+    "date_from": date_from,
+    "date_to": date_to,
+}
+
+# Changing any filter restarts pagination
+if filters != st.session_state.history_filters:
+    st.session_state.history_filters = filters
+    st.session_state.history_cursors = [None]
+
+total = store.count(**filters)
+page_number = len(st.session_state.history_cursors)
+entries, next_cursor = store.list_entries(
+    cursor=st.session_state.history_cursors[-1], limit=PAGE_SIZE, **filters
+)
+
+st.caption(f"{total}件")
+
+if not entries:
+    st.info("履歴がありません。")
+
+# Gallery grid (thumbnails only)
+for row_start in range(0, len(entries), GRID_COLUMNS):
+    cols = st.columns(GRID_COLUMNS)
+    for col, entry in zip(cols, entries[row_start:row_start + GRID_COLUMNS]):
+        with col:
+            thumbnail = store.load_thumbnail(entry["image_sha"])
+            if thumbnail:
+                st.image(thumbnail, use_container_width=True)
+            created = datetime.datetime.fromtimestamp(entry["created_at"]).strftime("%Y-%m-%d %H:%M")
+            st.caption(f"{entry['main_text']}\n\n{created}")
+            if st.button("開く", key=f"open_{entry['id']}", use_container_width=True):
+                st.session_state.history_selected_id = entry["id"]
+                st.rerun()
+
+# Pagination
+col_prev, col_page, col_next = st.columns([1, 2, 1])
+with col_prev:
+    if page_number > 1 and st.button("← 前へ", use_container_width=True):
+        st.session_state.history_cursors.pop()
+        st.rerun()
+with col_page:
+    total_pages = max(1, -(-total // PAGE_SIZE))
+    st.markdown(f"<div style='text-align: center;'>{page_number} / {total_pages}</div>", unsafe_allow_html=True)
+with col_next:
+    if next_cursor is not None and st.button("次へ →", use_container_width=True):
+        st.session_state.history_cursors.append(next_cursor)
+        st.rerun()
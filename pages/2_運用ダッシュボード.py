@@ -0,0 +1,108 @@
+import streamlit as st
+import pandas as pd
+import os
+import hmac
+import datetime
+
+from usage import UsageStore
+
+PERIODS = {"過去7日": 7, "過去30日": 30, "過去90日": 90}
+BREAKDOWNS = {"モデル別": "model", "見本デザイン別": "template", "タグ別": "tag", "リクエスト形状別": "shape", "呼び出し元別": "source"}
+
+st.set_page_config(
+    page_title="Gift Image Creator - 運用ダッシュボード",
+    page_icon="🎁",
+    layout="wide",
+    initial_sidebar_state="collapsed"
+)
+
+# Admin password from Streamlit Secrets or environment variable, same as the API key
+def get_admin_password():
+    try:
+        if hasattr(st, 'secrets') and 'ADMIN_PASSWORD' in st.secrets:
+            return st.secrets['ADMIN_PASSWORD']
+    except:
+        pass
+    return os.getenv("ADMIN_PASSWORD", "")
+
+@st.cache_resource
+def get_usage_store():
+    return UsageStore()
+
+st.markdown("## 運用ダッシュボード")
+
+admin_password = get_admin_password()
+if not admin_password:
+    st.warning("管理者パスワード（ADMIN_PASSWORD）が設定されていないため、このページは利用できません。")
+    st.stop()
+
+if not st.session_state.get("is_admin"):
+    password = st.text_input("管理者パスワード", type="password")
+    if password and hmac.compare_digest(password, admin_password):
+        st.session_state.is_admin = True
+        st.rerun()
+    elif password:
+        st.error("パスワードが違います。")
+    st.stop()
+
+store = get_usage_store()
+
+col_period, col_builds = st.columns([1, 2])
+period_label = col_period.selectbox("期間", options=list(PERIODS), index=1)
+# Offline background builds are excluded by default so they don't skew user traffic
+include_builds = col_builds.checkbox("背景ライブラリの生成を含める", value=False)
+days = PERIODS[period_label]
+since_day = (datetime.date.today() - datetime.timedelta(days=days)).isoformat()
+
+# Every figure below comes from this one read of the daily rollups
+report = store.report(since_day, include_builds)
+summary = report.summary()
+if summary is None:
+    st.info("この期間のAPI呼び出しはありません。")
+    st.stop()
+
+# Summary
+col_calls, col_cost, col_p50, col_p90 = st.columns(4)
+col_calls.metric("呼び出し数", f"{summary['calls']:,}", f"失敗 {summary['failures']}件", delta_color="off")
+col_cost.metric("推定コスト", f"${summary['total_cost_usd']:,.2f}")
+col_p50.metric("レイテンシ p50", f"{summary['p50_latency_s']:.1f}秒")
+col_p90.metric("レイテンシ p90", f"{summary['p90_latency_s']:.1f}秒")
+
+# Flagged request shapes
+for row in report.flagged_shapes():
+    st.warning(f"「{row['shape']}」のリクエストが割高です（{row['reason']}、{row['calls']}件）")
+
+# Percentiles over time for the selected breakdown
+st.markdown("#### 日別の推移")
+trend_label = st.radio("内訳", options=list(BREAKDOWNS), horizontal=True)
+trend_group = BREAKDOWNS[trend_label]
+daily = pd.DataFrame(report.daily(trend_group))
+col_cost_chart, col_p50_chart, col_p90_chart = st.columns(3)
+with col_cost_chart:
+    st.caption("コスト中央値（USD/回）")
+    st.line_chart(daily.pivot(index="day", columns=trend_group, values="median_cost_usd"))
+with col_p50_chart:
+    st.caption("レイテンシ p50（秒）")
+    st.line_chart(daily.pivot(index="day", columns=trend_group, values="p50_latency_s"))
+with col_p90_chart:
+    st.caption("レイテンシ p90（秒）")
+    st.line_chart(daily.pivot(index="day", columns=trend_group, values="p90_latency_s"))
+
+# Breakdowns with percentiles
+st.markdown("#### 内訳")
+tabs = st.tabs(list(BREAKDOWNS))
+for tab, group_by in zip(tabs, BREAKDOWNS.values()):
+    with tab:
+        st.dataframe(
+            pd.DataFrame(report.breakdown(group_by)),
+            use_container_width=True,
+            hide_index=True,
+            column_config={
+                "total_cost_usd": st.column_config.NumberColumn("合計コスト", format="$%.2f"),
+                "median_cost_usd": st.column_config.NumberColumn("コスト中央値", format="$%.4f"),
+                "avg_output_tokens": st.column_config.NumberColumn("平均出力トークン", format="%.0f"),
+                "p50_latency_s": st.column_config.NumberColumn("p50 (秒)", format="%.1f"),
+                "p90_latency_s": st.column_config.NumberColumn("p90 (秒)", format="%.1f"),
+                "p99_latency_s": st.column_config.NumberColumn("p99 (秒)", format="%.1f"),
+            },
+        )
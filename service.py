@@ -0,0 +1,352 @@
+import os
+import re
+import json
+import sqlite3
+import threading
+import time
+import uuid
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from dotenv import load_dotenv
+
+import core
+import backgrounds
+from image_dedup import PerceptualHashIndex
+from history import HistoryStore
+from usage import UsageStore
+
+# Headless generation service.
+# Jobs are persisted in SQLite, so queued work survives restarts and any number
+# of worker processes can share one queue:
+#
+#   python service.py serve --workers 2     # HTTP API + 2 workers
+#   python service.py worker --workers 4    # extra workers, no HTTP
+#
+# API:
+#   POST /jobs                 submit a job (core.encode_request format) -> 202 {"id", "status"}
+#                              "mode": "fast" composites from the background library instead
+#   GET  /jobs/<id>?wait=30    job status, optionally long-polling until it finishes
+#   GET  /jobs/<id>/image      generated PNG
+#   GET  /health
+
+load_dotenv()
+
+CACHE_DIR = os.getenv("GIFT_CACHE_DIR", ".cache")
+JOBS_DB_PATH = os.path.join(CACHE_DIR, "jobs.db")
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_WORKERS = int(os.getenv("GIFT_SERVICE_WORKERS", "2"))
+
+# Submissions are rejected with 503 once this many jobs are waiting
+MAX_QUEUED_JOBS = int(os.getenv("GIFT_SERVICE_MAX_QUEUED", "100"))
+# Workers renew the lease on their running job every heartbeat; a job whose
+# lease expires (its worker died) is handed out again
+JOB_LEASE_SECONDS = 120
+HEARTBEAT_SECONDS = 30
+MAX_WAIT_SECONDS = 60
+POLL_INTERVAL = 0.5
+MAX_BODY_BYTES = 64 * 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    claimed_at REAL,
+    claim_token TEXT,
+    request TEXT,
+    error TEXT,
+    history_id INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at);
+"""
+
+JOB_PATH = re.compile(r"^/jobs/([0-9a-f]{32})(/image)?$")
+
+
+class JobQueue:
+    def __init__(self, db_path=JOBS_DB_PATH):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def queued_count(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+    def submit(self, encoded_request):
+        # Returns the new job id, or None if the queue is full
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            queued = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+            if queued >= MAX_QUEUED_JOBS:
+                conn.execute("ROLLBACK")
+                return None
+            conn.execute(
+                "INSERT INTO jobs (id, status, created_at, updated_at, request) VALUES (?, 'queued', ?, ?, ?)",
+                (job_id, now, now, json.dumps(encoded_request)),
+            )
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        return job_id
+
+    def claim(self):
+        # Atomically takes the oldest queued (or lease-expired running) job.
+        # Returns (job_id, claim_token, encoded_request) or None; the token must be
+        # passed to renew() and finish().
+        now = time.time()
+        token = uuid.uuid4().hex
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT id, request FROM jobs"
+                " WHERE status = 'queued' OR (status = 'running' AND claimed_at < ?)"
+                " ORDER BY created_at LIMIT 1",
+                (now - JOB_LEASE_SECONDS,),
+            ).fetchone()
+            if row is None:
+                conn.execute("ROLLBACK")
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', claimed_at = ?, claim_token = ?, updated_at = ? WHERE id = ?",
+                (now, token, now, row["id"]),
+            )
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        return row["id"], token, json.loads(row["request"])
+
+    def renew(self, job_id, token):
+        # Extends the lease; returns False if the job was reclaimed by another worker
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET claimed_at = ? WHERE id = ? AND status = 'running' AND claim_token = ?",
+                (time.time(), job_id, token),
+            )
+            return cursor.rowcount == 1
+
+    def finish(self, job_id, token, history_id=None, error=None):
+        # Only the current claim holder may finish a job.
+        # Inputs are dropped once a job is done, only the result is kept.
+        status = "failed" if error else "done"
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, history_id = ?, request = NULL, claim_token = NULL,"
+                " updated_at = ? WHERE id = ? AND status = 'running' AND claim_token = ?",
+                (status, error, history_id, time.time(), job_id, token),
+            )
+            return cursor.rowcount == 1
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT id, status, created_at, updated_at, error, history_id FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        return dict(row) if row else None
+
+
+def _heartbeat(queue, job_id, token, done):
+    while not done.wait(HEARTBEAT_SECONDS):
+        if not queue.renew(job_id, token):
+            return
+
+
+def worker_loop(queue, api_key, phash_index, history_store, usage_store, library, stop_event):
+    while not stop_event.is_set():
+        job = queue.claim()
+        if job is None:
+            stop_event.wait(POLL_INTERVAL)
+            continue
+
+        job_id, token, encoded = job
+        done = threading.Event()
+        heartbeat = threading.Thread(target=_heartbeat, args=(queue, job_id, token, done), daemon=True)
+        heartbeat.start()
+        try:
+            request = core.decode_request(encoded)
+            if request.get("mode") == "fast":
+                result, error = backgrounds.run_composite(request, library, phash_index, history_store)
+            else:
+                result, error = core.run_generation(request, api_key, phash_index, history_store, usage_store, source="service")
+        except Exception as e:
+            result, error = None, f"エラーが発生しました: {str(e)}"
+        finally:
+            done.set()
+
+        if error:
+            finished = queue.finish(job_id, token, error=error)
+        elif result["history_id"] is None:
+            finished = queue.finish(job_id, token, error="生成結果の保存に失敗しました。")
+        else:
+            finished = queue.finish(job_id, token, history_id=result["history_id"])
+        if not finished:
+            print(f"Job {job_id} was reclaimed by another worker, result discarded")
+
+
+def start_workers(queue, api_key, count, stop_event):
+    # The dedup index and the history / usage stores are thread-safe and shared by all workers;
+    # all are SQLite-backed, so worker processes and the app share them too
+    phash_index = PerceptualHashIndex()
+    history_store = HistoryStore()
+    usage_store = UsageStore()
+    library = backgrounds.BackgroundLibrary()
+    threads = []
+    for i in range(count):
+        thread = threading.Thread(
+            target=worker_loop,
+            args=(queue, api_key, phash_index, history_store, usage_store, library, stop_event),
+            name=f"gift-worker-{i}",
+            daemon=True,
+        )
+        thread.start()
+        threads.append(thread)
+    return threads
+
+
+def job_response(job):
+    response = {
+        "id": job["id"],
+        "status": job["status"],
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"],
+    }
+    if job["status"] == "failed":
+        response["error"] = job["error"]
+    if job["status"] == "done":
+        response["history_id"] = job["history_id"]
+        response["image_url"] = f"/jobs/{job['id']}/image"
+    return response
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    queue = None
+    history_store = None
+
+    def _send_json(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if urlparse(self.path).path != "/jobs":
+            return self._send_json(404, {"error": "not found"})
+
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            return self._send_json(400, {"error": "invalid Content-Length"})
+        if length <= 0 or length > MAX_BODY_BYTES:
+            return self._send_json(413 if length > 0 else 400, {"error": "invalid request size"})
+        try:
+            encoded = json.loads(self.rfile.read(length))
+            # Validate up front so malformed jobs never reach the queue
+            request = core.decode_request(encoded)
+        except ValueError as e:
+            return self._send_json(400, {"error": str(e)})
+        if not request["images"]:
+            return self._send_json(400, {"error": "images must not be empty"})
+        if request.get("aspect_ratio") not in core.ASPECT_RATIOS:
+            return self._send_json(400, {"error": f"aspect_ratio must be one of {core.ASPECT_RATIOS}"})
+
+        job_id = self.queue.submit(encoded)
+        if job_id is None:
+            return self._send_json(503, {"error": "queue is full"})
+        self._send_json(202, {"id": job_id, "status": "queued"})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/health":
+            return self._send_json(200, {"status": "ok", "queued": self.queue.queued_count()})
+
+        match = JOB_PATH.match(url.path)
+        if not match:
+            return self._send_json(404, {"error": "not found"})
+        job_id, wants_image = match.group(1), match.group(2)
+
+        job = self.queue.get(job_id)
+        if job is None:
+            return self._send_json(404, {"error": "job not found"})
+
+        if wants_image:
+            return self._send_image(job)
+
+        # Long-poll: hold the request until the job finishes or `wait` expires
+        try:
+            wait = min(float(parse_qs(url.query).get("wait", ["0"])[0]), MAX_WAIT_SECONDS)
+        except ValueError:
+            wait = 0
+        deadline = time.monotonic() + wait
+        while job["status"] in ("queued", "running") and time.monotonic() < deadline:
+            time.sleep(POLL_INTERVAL)
+            job = self.queue.get(job_id)
+        self._send_json(200, job_response(job))
+
+    def _send_image(self, job):
+        if job["status"] != "done":
+            return self._send_json(409, {"error": f"job is {job['status']}"})
+        entry = self.history_store.get(job["history_id"])
+        image_data = self.history_store.load_image(entry["image_sha"]) if entry else None
+        if image_data is None:
+            return self._send_json(410, {"error": "image no longer available"})
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(image_data)))
+        self.end_headers()
+        self.wfile.write(image_data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gift image generation service")
+    parser.add_argument("mode", choices=["serve", "worker"])
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    args = parser.parse_args()
+
+    api_key = os.getenv("GOOGLE_API_KEY", "")
+    if args.workers > 0 and not api_key:
+        parser.error("GOOGLE_API_KEY is not set")
+
+    queue = JobQueue()
+    stop_event = threading.Event()
+    threads = start_workers(queue, api_key, args.workers, stop_event)
+
+    try:
+        if args.mode == "serve":
+            ServiceHandler.queue = queue
+            ServiceHandler.history_store = HistoryStore()
+            server = ThreadingHTTPServer((args.host, args.port), ServiceHandler)
+            print(f"Serving on http://{args.host}:{args.port} with {args.workers} worker(s)")
+            server.serve_forever()
+        else:
+            print(f"Running {args.workers} worker(s)")
+            for thread in threads:
+                thread.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_event.set()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image, ImageFont
+
+import backgrounds
+from history import HistoryStore
+from image_dedup import PerceptualHashIndex
+
+
+def png(shade):
+    buf = io.BytesIO()
+    Image.new("RGB", (16, 16), (shade, 0, 0)).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def test_background_cache_is_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(backgrounds, "BACKGROUND_CACHE_SIZE", 2)
+    library = backgrounds.BackgroundLibrary(str(tmp_path), str(tmp_path / "manifest.json"))
+    for i, ratio in enumerate(["1:1", "16:9", "9:16"]):
+        library.add("和風", ratio, None, png(i * 50))
+        library.get("和風", ratio)
+    assert len(library._cache) == 2
+
+
+def test_composite_refuses_without_japanese_font(monkeypatch):
+    monkeypatch.setattr(backgrounds, "find_font_path", lambda: None)
+    result, error = backgrounds.run_composite({"images": [(png(0), "a.png")], "tag": "和風"}, None, None)
+    assert result is None
+    assert "フォント" in error
+
+
+def product_shot(color, size=(300, 400)):
+    # Product on a plain white backdrop, as most shop photos are
+    image = Image.new("RGB", size, "white")
+    width, height = size
+    image.paste(color, (width // 5, height // 6, width - width // 5, height - height // 20))
+    return image
+
+
+def gradient(size):
+    width, height = size
+    column = np.linspace(180, 240, height, dtype=np.uint8)[:, None, None]
+    return Image.fromarray(np.broadcast_to(column, (height, width, 3)).copy())
+
+
+def to_png(image):
+    buf = io.BytesIO()
+    image.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def reds(image):
+    pixels = np.asarray(image.convert("RGB"), dtype=np.int16)
+    return (pixels[:, :, 0] > 150) & (pixels[:, :, 1] < 80) & (pixels[:, :, 2] < 80)
+
+
+@pytest.fixture
+def default_font(monkeypatch):
+    # No Japanese font in the test environment; layout doesn't depend on glyphs
+    monkeypatch.setattr(backgrounds, "load_font", lambda size: ImageFont.load_default(size))
+    monkeypatch.setattr(backgrounds, "is_available", lambda: True)
+
+
+def test_products_are_placed_in_product_area(default_font):
+    background = gradient((1024, 768))
+    data = backgrounds.composite_banner(
+        background, [product_shot((220, 20, 20)), product_shot((20, 20, 220))], "Gift", "Selection"
+    )
+    image = Image.open(io.BytesIO(data))
+    assert image.size == background.size
+
+    rows, cols = np.nonzero(reds(image))
+    assert rows.min() >= int(768 * backgrounds.PRODUCT_AREA_TOP)
+    assert rows.max() <= int(768 * backgrounds.PRODUCT_AREA_BOTTOM)
+    # First of two products sits in the left half
+    assert cols.max() < 512
+
+
+@pytest.mark.parametrize("size, count", [((1024, 1024), 30), ((576, 1024), 24), ((576, 1024), 60)])
+def test_many_products_wrap_into_rows(default_font, size, count):
+    products = [product_shot((220, 20, 20), (120, 160))] * count
+    image = Image.open(io.BytesIO(backgrounds.composite_banner(gradient(size), products, "Gift", "")))
+    assert image.size == size
+
+    rows, _ = np.nonzero(reds(image))
+    assert rows.min() >= int(size[1] * backgrounds.PRODUCT_AREA_TOP)
+
+
+def test_run_composite_from_library(default_font, tmp_path):
+    library = backgrounds.BackgroundLibrary(str(tmp_path / "backgrounds"), str(tmp_path / "manifest.json"))
+    library.add("和風", "4:3", None, to_png(gradient((1024, 768))))
+    phash_index = PerceptualHashIndex(str(tmp_path / "index.db"), str(tmp_path / "assets"))
+    history_store = HistoryStore(str(tmp_path / "history.db"), str(tmp_path / "history"))
+
+    result, error = backgrounds.run_composite({
+        "images": [(to_png(product_shot((220, 20, 20))), "a.png")],
+        "tag": "和風",
+        "aspect_ratio": "4:3",
+        "main_text": "Gift",
+    }, library, phash_index, history_store)
+    assert error is None
+    assert Image.open(io.BytesIO(result["image_data"])).size == (1024, 768)
+    assert result["latency_ms"] < 1000
+    assert history_store.get(result["history_id"])["model"] == backgrounds.LOCAL_MODEL
@@ -0,0 +1,105 @@
+import io
+
+import pytest
+from PIL import Image
+
+import history
+from history import HistoryStore
+
+
+def png(shade):
+    buf = io.BytesIO()
+    Image.new("RGB", (8, 8), (shade, 0, 0)).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+@pytest.fixture
+def store(tmp_path):
+    return HistoryStore(str(tmp_path / "history.db"), str(tmp_path / "images"))
+
+
+def add_at(store, monkeypatch, created_at, **fields):
+    monkeypatch.setattr(history.time, "time", lambda: created_at)
+    return store.add(png(int(created_at) % 256), **fields)
+
+
+def all_pages(store, limit, **filters):
+    pages = []
+    cursor = None
+    while True:
+        entries, cursor = store.list_entries(cursor=cursor, limit=limit, **filters)
+        pages.append([entry["id"] for entry in entries])
+        if cursor is None:
+            return pages
+
+
+def test_pages_cover_every_entry_once_despite_timestamp_ties(store, monkeypatch):
+    # Three entries share each timestamp, so page boundaries fall inside ties
+    keys = []
+    for i in range(60):
+        created_at = 1000.0 + i // 3
+        keys.append((created_at, add_at(store, monkeypatch, created_at)))
+
+    pages = all_pages(store, 7)
+    seen = [entry_id for page in pages for entry_id in page]
+    assert seen == [entry_id for _, entry_id in sorted(keys, reverse=True)]
+    assert len(pages) == 9 and len(pages[-1]) == 4
+
+
+def test_last_full_page_has_no_cursor(store, monkeypatch):
+    for i in range(14):
+        add_at(store, monkeypatch, 1000.0 + i)
+
+    first, cursor = store.list_entries(limit=7)
+    second, cursor = store.list_entries(cursor=cursor, limit=7)
+    assert len(first) == len(second) == 7
+    assert cursor is None
+
+
+def test_full_text_search_matches_japanese_substrings(store):
+    assert store.has_fts
+    store.add(png(1), main_text="冬の贈り物セレクション", sub_text="送料無料")
+    store.add(png(2), main_text="夏のギフト", prompt_style="和風の落ち着いたデザイン")
+    store.add(png(3), main_text='"特選" 贈り物')
+
+    assert store.count(query="贈り物") == 2
+    assert store.count(query="落ち着いた") == 1
+    assert store.count(query='"特選"') == 1
+    assert store.count(query="存在しない語") == 0
+
+
+def test_like_fallback_without_fts(store):
+    store.add(png(1), main_text="冬の贈り物セレクション")
+    store.has_fts = False
+    assert store.count(query="贈り物") == 1
+    assert store.count(query="夏") == 0
+
+
+def test_filters_combine_with_pagination(store, monkeypatch):
+    for i in range(30):
+        add_at(
+            store, monkeypatch, 1000.0 + i,
+            main_text=f"商品{i}",
+            campaign="歳暮" if i % 2 else "中元",
+            tag="和風" if i % 3 == 0 else "ポップ",
+        )
+
+    assert store.count(campaign="歳暮") == 15
+    assert store.count(tag="和風") == 10
+    assert store.count(campaign="歳暮", tag="和風") == 5
+    assert store.count(date_from=1010.0, date_to=1020.0) == 10
+    assert store.campaigns() == ["中元", "歳暮"]
+    assert store.tags() == ["ポップ", "和風"]
+
+    pages = all_pages(store, 4, campaign="歳暮", date_from=1010.0)
+    entries = [store.get(entry_id) for page in pages for entry_id in page]
+    assert [entry["created_at"] for entry in entries] == [1000.0 + i for i in range(29, 9, -1) if i % 2]
+
+
+def test_short_queries_treat_wildcards_literally(store):
+    for i, text in enumerate(["50%オフ", "5000円", "a_b", "axb"]):
+        store.add(png(i * 40), main_text=text)
+
+    assert store.count(query="0%") == 1
+    assert store.count(query="a_") == 1
+    assert store.count(query="%") == 1
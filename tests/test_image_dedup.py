@@ -0,0 +1,126 @@
+import io
+
+import pytest
+from PIL import Image, ImageDraw, ImageFont
+
+from image_dedup import PerceptualHashIndex, dedupe_images
+
+
+def box_shot(color=(200, 30, 30), label="COFFEE", size=(800, 800)):
+    image = Image.new("RGB", (800, 800), "white")
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((200, 200, 600, 650), fill=color)
+    draw.rectangle((260, 330, 540, 480), fill="white")
+    draw.text((280, 380), label, fill="black", font=ImageFont.load_default(48))
+    return image.resize(size, Image.LANCZOS)
+
+
+def to_jpeg(image, quality=90):
+    buf = io.BytesIO()
+    image.save(buf, format="JPEG", quality=quality)
+    return buf.getvalue()
+
+
+def box_pixel(data):
+    image = Image.open(io.BytesIO(data)).convert("RGB")
+    # Inside the box, above the label
+    return image.getpixel((image.width // 2, int(image.height * 0.3)))
+
+
+@pytest.fixture
+def make_index(tmp_path):
+    def make():
+        return PerceptualHashIndex(str(tmp_path / "index.db"), str(tmp_path / "assets"))
+    return make
+
+
+def test_reexport_is_deduplicated(make_index):
+    unique, duplicates = dedupe_images(
+        [(to_jpeg(box_shot()), "a.jpg"), (to_jpeg(box_shot(size=(400, 400)), quality=40), "b.jpg")],
+        make_index(),
+    )
+    assert len(unique) == 1
+    assert duplicates == ["b.jpg"]
+
+
+def test_colour_variants_are_kept_within_request(make_index):
+    unique, duplicates = dedupe_images(
+        [(to_jpeg(box_shot((200, 30, 30))), "red.jpg"), (to_jpeg(box_shot((30, 30, 200))), "blue.jpg")],
+        make_index(),
+    )
+    assert [name for _, _, name in unique] == ["red.jpg", "blue.jpg"]
+    assert duplicates == []
+
+
+def test_colour_variant_does_not_resolve_to_other_asset(make_index):
+    make_index().canonicalize(to_jpeg(box_shot((200, 30, 30))))
+    data, _, _ = make_index().canonicalize(to_jpeg(box_shot((30, 30, 200))))
+    red, green, blue = box_pixel(data)
+    assert blue > 150 and red < 100
+
+
+def test_label_text_variants_are_kept(make_index):
+    unique, _ = dedupe_images(
+        [(to_jpeg(box_shot(label="COFFEE")), "coffee.jpg"), (to_jpeg(box_shot(label="TEA")), "tea.jpg")],
+        make_index(),
+    )
+    assert len(unique) == 2
+
+
+def test_larger_upload_replaces_smaller_asset(make_index):
+    index = make_index()
+    small, _, key = index.canonicalize(to_jpeg(box_shot(size=(300, 300))))
+    large, _, large_key = index.canonicalize(to_jpeg(box_shot(size=(900, 900))))
+    assert large_key == key
+    assert Image.open(io.BytesIO(large)).size == (900, 900)
+
+    # The upgraded asset is what later near-duplicates and new sessions get
+    again, _, _ = make_index().canonicalize(to_jpeg(box_shot(size=(300, 300)), quality=60))
+    assert again == large
+
+
+def test_within_request_upgrade_sends_larger_asset(make_index):
+    unique, duplicates = dedupe_images(
+        [(to_jpeg(box_shot(size=(300, 300))), "small.jpg"), (to_jpeg(box_shot(size=(900, 900))), "large.jpg")],
+        make_index(),
+    )
+    assert duplicates == ["large.jpg"]
+    assert Image.open(io.BytesIO(unique[0][0])).size == (900, 900)
+
+
+def test_smaller_duplicate_after_larger_keeps_larger_asset(make_index):
+    index = make_index()
+    small = to_jpeg(box_shot(size=(300, 300)))
+    large = to_jpeg(box_shot(size=(900, 900)))
+    index.canonicalize(small)
+    index.canonicalize(large)
+
+    unique, duplicates = dedupe_images([(large, "large.jpg"), (small, "small.jpg")], index)
+    assert duplicates == ["small.jpg"]
+    assert Image.open(io.BytesIO(unique[0][0])).size == (900, 900)
+
+    # The memoised small upload resolves to the upgraded asset, not the removed one
+    data, _, _ = index.canonicalize(small)
+    assert Image.open(io.BytesIO(data)).size == (900, 900)
+
+
+def test_indexes_sharing_a_path_see_each_others_entries(make_index):
+    first, second = make_index(), make_index()
+    _, _, red_key = first.canonicalize(to_jpeg(box_shot((200, 30, 30))))
+    _, _, blue_key = second.canonicalize(to_jpeg(box_shot((30, 30, 200))))
+
+    # Each instance resolves the other's product, and a fresh one sees both
+    assert second.canonicalize(to_jpeg(box_shot((200, 30, 30)), quality=60))[2] == red_key
+    assert first.canonicalize(to_jpeg(box_shot((30, 30, 200)), quality=60))[2] == blue_key
+    assert len(make_index()._entries) == 2
+
+
+def test_upgrade_by_another_index_is_picked_up(make_index):
+    first, second = make_index(), make_index()
+    small = to_jpeg(box_shot(size=(300, 300)))
+    first.canonicalize(small)
+    second.canonicalize(to_jpeg(box_shot(size=(900, 900))))
+
+    # The first instance's memo and entry point at the removed small asset
+    data, _, _ = first.canonicalize(small)
+    assert Image.open(io.BytesIO(data)).size == (900, 900)
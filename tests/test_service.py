@@ -0,0 +1,127 @@
+import io
+import json
+import http.client
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import pytest
+from PIL import Image
+
+import core
+import service
+from history import HistoryStore
+from image_dedup import PerceptualHashIndex
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return service.JobQueue(str(tmp_path / "jobs.db"))
+
+
+@pytest.fixture
+def history_store(tmp_path):
+    return HistoryStore(str(tmp_path / "history.db"), str(tmp_path / "history"))
+
+
+@pytest.fixture
+def server_url(queue, history_store):
+    service.ServiceHandler.queue = queue
+    service.ServiceHandler.history_store = history_store
+    server = ThreadingHTTPServer(("127.0.0.1", 0), service.ServiceHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+def png(color, size=(64, 64)):
+    buf = io.BytesIO()
+    Image.new("RGB", size, color).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def post_job(url, body):
+    request = urllib.request.Request(url + "/jobs", data=json.dumps(body).encode("utf-8"), method="POST")
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def get_json(url):
+    with urllib.request.urlopen(url, timeout=10) as response:
+        return json.loads(response.read())
+
+
+@pytest.mark.parametrize("body", [
+    [],
+    {"images": ["x"], "aspect_ratio": "1:1"},
+    {"images": [{"data": "aGk="}], "aspect_ratio": "1:1", "reference_image": "x"},
+    {"images": [{"data": "aGk="}], "aspect_ratio": "1:1", "template": 1},
+    {"images": [{"data": 1}], "aspect_ratio": "1:1"},
+])
+def test_wrong_shape_is_rejected_with_400(server_url, body):
+    assert post_job(server_url, body) == 400
+
+
+def test_only_current_claim_can_finish(queue, monkeypatch):
+    job_id = queue.submit({"images": []})
+    _, stale_token, _ = queue.claim()
+
+    # Lease expires and another worker takes the job over
+    monkeypatch.setattr(service, "JOB_LEASE_SECONDS", -1)
+    _, token, _ = queue.claim()
+
+    assert not queue.renew(job_id, stale_token)
+    assert not queue.finish(job_id, stale_token, error="late")
+    assert queue.get(job_id)["status"] == "running"
+    assert queue.finish(job_id, token, history_id=1)
+    assert queue.get(job_id)["status"] == "done"
+
+
+def test_non_numeric_content_length_is_rejected_with_400(server_url):
+    conn = http.client.HTTPConnection(server_url.removeprefix("http://"), timeout=5)
+    conn.putrequest("POST", "/jobs")
+    conn.putheader("Content-Length", "abc")
+    conn.endheaders()
+    assert conn.getresponse().status == 400
+
+
+def test_job_runs_to_image(server_url, queue, history_store, tmp_path, monkeypatch):
+    generated = png((10, 120, 200), (128, 96))
+    monkeypatch.setattr(core, "call_model",
+                        lambda *args, **kwargs: ({"image_data": generated, "latency_ms": 5}, None))
+    phash_index = PerceptualHashIndex(str(tmp_path / "index.db"), str(tmp_path / "assets"))
+    stop_event = threading.Event()
+    worker = threading.Thread(
+        target=service.worker_loop,
+        args=(queue, "key", phash_index, history_store, None, None, stop_event),
+        daemon=True,
+    )
+    worker.start()
+    try:
+        request = urllib.request.Request(
+            server_url + "/jobs",
+            data=json.dumps(core.encode_request({
+                "images": [(png((200, 30, 30)), "product.png")],
+                "main_text": "お歳暮",
+                "aspect_ratio": "4:3",
+            })).encode("utf-8"),
+            method="POST",
+        )
+        with urllib.request.urlopen(request, timeout=5) as response:
+            assert response.status == 202
+            job_id = json.loads(response.read())["id"]
+
+        job = get_json(f"{server_url}/jobs/{job_id}?wait=10")
+        assert job["status"] == "done"
+        assert history_store.get(job["history_id"])["main_text"] == "お歳暮"
+
+        with urllib.request.urlopen(server_url + job["image_url"], timeout=5) as response:
+            assert response.headers["Content-Type"] == "image/png"
+            assert response.read() == generated
+    finally:
+        stop_event.set()
+        worker.join(timeout=5)
@@ -0,0 +1,125 @@
+import io
+import datetime
+
+import pytest
+from PIL import Image
+
+import core
+import usage
+from image_dedup import PerceptualHashIndex
+from usage import UsageStore
+
+
+class FakeStore:
+    def __init__(self):
+        self.calls = []
+
+    def record(self, **kwargs):
+        self.calls.append(kwargs)
+
+
+def png():
+    buf = io.BytesIO()
+    Image.new("RGB", (32, 32), (200, 30, 30)).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def payload():
+    return core.build_payload("prompt", [(b"x", "image/png")], "1:1")
+
+
+def test_thinking_tokens_are_priced_as_text():
+    store = FakeStore()
+    result = {"usageMetadata": {
+        "promptTokenCount": 1000,
+        "candidatesTokenCount": 1200,
+        "thoughtsTokenCount": 300,
+        "candidatesTokensDetails": [
+            {"modality": "IMAGE", "tokenCount": 1120},
+            {"modality": "TEXT", "tokenCount": 80},
+        ],
+    }}
+    core._record_usage(store, None, core.DEFAULT_MODEL, payload(), "{}", 10, result=result)
+
+    call = store.calls[0]
+    assert call["image_output_tokens"] == 1120
+    assert call["text_output_tokens"] == 380
+    cost = usage.estimate_cost(core.DEFAULT_MODEL, 1000, 380, 1120, usage.DEFAULT_PRICES)
+    assert cost == pytest.approx((1000 * 2.0 + 380 * 12.0 + 1120 * 120.0) / 1_000_000)
+
+
+def test_candidates_without_details_are_image_output():
+    store = FakeStore()
+    result = {"usageMetadata": {"candidatesTokenCount": 1120, "thoughtsTokenCount": 50}}
+    core._record_usage(store, None, core.DEFAULT_MODEL, payload(), "{}", 10, result=result)
+
+    assert store.calls[0]["image_output_tokens"] == 1120
+    assert store.calls[0]["text_output_tokens"] == 50
+
+
+def test_histogram_percentiles_are_close():
+    histogram = {}
+    for value in range(1000, 101000, 1000):
+        bucket = usage.to_bucket(value)
+        histogram[bucket] = histogram.get(bucket, 0) + 1
+
+    assert usage.histogram_percentile(histogram, 50) == pytest.approx(50000, rel=0.06)
+    assert usage.histogram_percentile(histogram, 90) == pytest.approx(90000, rel=0.06)
+
+
+def test_report_from_rollups(tmp_path):
+    store = UsageStore(str(tmp_path / "usage.db"))
+    for latency_ms in (1000, 2000, 3000) * 3:
+        store.record(core.DEFAULT_MODEL, latency_ms, 1, 100, image_output_tokens=1120, output_size="1K", tag="和風")
+    for _ in range(5):
+        store.record(core.DEFAULT_MODEL, 30000, 6, 100, image_output_tokens=2000, output_size="4K", tag="ポップ")
+
+    report = store.report((datetime.date.today() - datetime.timedelta(days=1)).isoformat())
+    assert report.summary()["calls"] == 14
+
+    daily = {row["tag"]: row for row in report.daily("tag")}
+    assert daily["和風"]["day"] == datetime.date.today().isoformat()
+    assert daily["和風"]["p50_latency_s"] == pytest.approx(2.0, rel=0.06)
+    assert daily["ポップ"]["p90_latency_s"] == pytest.approx(30.0, rel=0.06)
+    assert daily["ポップ"]["median_cost_usd"] == pytest.approx(2000 * 120.0 / 1_000_000, rel=0.06)
+
+    flagged = report.flagged_shapes()
+    assert [row["shape"] for row in flagged] == ["6+枚 / 4K"]
+
+
+def test_background_builds_are_left_out_of_user_figures(tmp_path):
+    store = UsageStore(str(tmp_path / "usage.db"))
+    for _ in range(3):
+        store.record(core.DEFAULT_MODEL, 2000, 1, 100, image_output_tokens=1120, output_size="1K",
+                     tag="和風", source="app")
+    for _ in range(10):
+        store.record(core.DEFAULT_MODEL, 40000, 0, 100, image_output_tokens=1120, output_size="1K",
+                     tag="和風", source=usage.BUILD_SOURCE)
+
+    since_day = datetime.date.today().isoformat()
+    report = store.report(since_day)
+    assert report.summary()["calls"] == 3
+    assert report.breakdown("tag")[0]["p50_latency_s"] == pytest.approx(2.0, rel=0.06)
+    assert [row["shape"] for row in report.breakdown("shape")] == ["1枚 / 1K"]
+
+    sources = {row["source"]: row["calls"] for row in store.report(since_day, include_builds=True).breakdown("source")}
+    assert sources == {"app": 3, usage.BUILD_SOURCE: 10}
+
+
+def test_uploaded_references_share_one_template_label(tmp_path, monkeypatch):
+    contexts = []
+
+    def call_model(api_key, model_name, payload, usage_store=None, context=None):
+        contexts.append(context)
+        return None, "stubbed"
+
+    monkeypatch.setattr(core, "call_model", call_model)
+    phash_index = PerceptualHashIndex(str(tmp_path / "index.db"), str(tmp_path / "assets"))
+    for name in ("a.png", "b.png"):
+        core.run_generation({
+            "images": [(png(), "product.png")],
+            "aspect_ratio": "1:1",
+            "template": {"label": f"参照デザイン: {name}", "data": png(), "mime_type": "image/png"},
+        }, "key", phash_index)
+
+    assert [context["template"] for context in contexts] == [core.CUSTOM_TEMPLATE_LABEL] * 2
@@ -0,0 +1,319 @@
+import os
+import json
+import math
+import sqlite3
+import threading
+import time
+
+# Append-only accounting of model calls: tokens, payload size and latency.
+# Raw calls are kept as an audit log. On insert, per-day counters and log-bucketed
+# latency / cost histograms are upserted per source x model x template x tag x shape,
+# so totals and percentiles over any period come from the rollups alone.
+
+CACHE_DIR = os.getenv("GIFT_CACHE_DIR", ".cache")
+USAGE_DB_PATH = os.path.join(CACHE_DIR, "usage.db")
+
+# USD per 1M tokens (list prices; override with GIFT_MODEL_PRICES as JSON in the same shape).
+# Thinking tokens are billed as text output.
+DEFAULT_PRICES = {
+    "gemini-3-pro-image-preview": {"input": 2.00, "text_output": 12.00, "image_output": 120.00},
+    "gemini-2.5-flash-image": {"input": 0.30, "text_output": 2.50, "image_output": 30.00},
+}
+
+# Calls made by the offline background library build, not by users
+BUILD_SOURCE = "background-build"
+
+# A request shape is flagged when it is this many times the overall median
+SHAPE_FLAG_RATIO = 1.5
+SHAPE_MIN_CALLS = 5
+
+# Histogram buckets grow by 10%, so percentiles are accurate to about +-5%.
+# Latency is bucketed in milliseconds, cost in micro-USD.
+BUCKET_GROWTH = 1.1
+METRICS = ("latency", "cost")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS calls (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at REAL NOT NULL,
+    day TEXT NOT NULL,
+    source TEXT,
+    model TEXT NOT NULL,
+    template TEXT,
+    tag TEXT,
+    aspect_ratio TEXT,
+    image_count INTEGER NOT NULL,
+    payload_bytes INTEGER NOT NULL,
+    output_size TEXT,
+    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+    output_tokens INTEGER NOT NULL DEFAULT 0,
+    text_output_tokens INTEGER NOT NULL DEFAULT 0,
+    image_output_tokens INTEGER NOT NULL DEFAULT 0,
+    total_tokens INTEGER NOT NULL DEFAULT 0,
+    cost_usd REAL NOT NULL DEFAULT 0,
+    latency_ms INTEGER NOT NULL,
+    status_code INTEGER,
+    finish_reason TEXT,
+    ok INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_calls_created ON calls (created_at);
+
+CREATE TABLE IF NOT EXISTS daily_stats (
+    day TEXT NOT NULL,
+    source TEXT NOT NULL,
+    model TEXT NOT NULL,
+    template TEXT NOT NULL,
+    tag TEXT NOT NULL,
+    shape TEXT NOT NULL,
+    calls INTEGER NOT NULL,
+    failures INTEGER NOT NULL,
+    prompt_tokens INTEGER NOT NULL,
+    output_tokens INTEGER NOT NULL,
+    cost_usd REAL NOT NULL,
+    latency_ms INTEGER NOT NULL,
+    PRIMARY KEY (day, source, model, template, tag, shape)
+);
+
+CREATE TABLE IF NOT EXISTS daily_histograms (
+    day TEXT NOT NULL,
+    source TEXT NOT NULL,
+    model TEXT NOT NULL,
+    template TEXT NOT NULL,
+    tag TEXT NOT NULL,
+    shape TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    calls INTEGER NOT NULL,
+    PRIMARY KEY (day, source, model, template, tag, shape, metric, bucket)
+);
+"""
+
+STATS_UPSERT = """
+INSERT INTO daily_stats (day, source, model, template, tag, shape, calls, failures, prompt_tokens, output_tokens, cost_usd, latency_ms)
+VALUES (?, ?, ?, ?, ?, ?, 1, ?, ?, ?, ?, ?)
+ON CONFLICT (day, source, model, template, tag, shape) DO UPDATE SET
+    calls = calls + 1,
+    failures = failures + excluded.failures,
+    prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+    output_tokens = output_tokens + excluded.output_tokens,
+    cost_usd = cost_usd + excluded.cost_usd,
+    latency_ms = latency_ms + excluded.latency_ms
+"""
+
+HISTOGRAM_UPSERT = """
+INSERT INTO daily_histograms (day, source, model, template, tag, shape, metric, bucket, calls)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1)
+ON CONFLICT (day, source, model, template, tag, shape, metric, bucket) DO UPDATE SET
+    calls = calls + 1
+"""
+
+GROUP_COLUMNS = ("source", "model", "template", "tag", "shape")
+
+
+def load_prices():
+    prices = dict(DEFAULT_PRICES)
+    override = os.getenv("GIFT_MODEL_PRICES")
+    if override:
+        try:
+            prices.update(json.loads(override))
+        except ValueError as e:
+            print(f"Error parsing GIFT_MODEL_PRICES: {e}")
+    return prices
+
+
+def estimate_cost(model, prompt_tokens, text_output_tokens, image_output_tokens, prices=None):
+    price = (prices or load_prices()).get(model)
+    if not price:
+        return 0.0
+    return (prompt_tokens * price.get("input", 0)
+            + text_output_tokens * price.get("text_output", 0)
+            + image_output_tokens * price.get("image_output", 0)) / 1_000_000
+
+
+def output_size_label(width, height):
+    # Matches the API's imageSize buckets
+    long_side = max(width, height)
+    if long_side <= 1024:
+        return "1K"
+    if long_side <= 2048:
+        return "2K"
+    return "4K"
+
+
+def request_shape(image_count, output_size):
+    # Coarse buckets so similar requests are compared together
+    if image_count >= 6:
+        images = "6+枚"
+    elif image_count >= 4:
+        images = "4-5枚"
+    elif image_count >= 2:
+        images = "2-3枚"
+    elif image_count == 1:
+        images = "1枚"
+    else:
+        images = "商品なし"
+    return f"{images} / {output_size or '不明'}"
+
+
+def to_bucket(value):
+    # Bucket -1 holds zero (e.g. failed calls that cost nothing)
+    if value < 1:
+        return -1
+    return int(math.log(value) / math.log(BUCKET_GROWTH))
+
+
+def bucket_value(bucket):
+    # Geometric middle of the bucket
+    if bucket < 0:
+        return 0.0
+    return BUCKET_GROWTH ** (bucket + 0.5)
+
+
+def histogram_percentile(histogram, q):
+    # histogram: {bucket: calls}; q in [0, 100]
+    total = sum(histogram.values())
+    if total == 0:
+        return 0.0
+    rank = q / 100 * total
+    seen = 0
+    for bucket in sorted(histogram):
+        seen += histogram[bucket]
+        if seen >= rank:
+            return bucket_value(bucket)
+    return bucket_value(max(histogram))
+
+
+class UsageStore:
+    def __init__(self, db_path=USAGE_DB_PATH):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._prices = load_prices()
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def record(self, model, latency_ms, image_count, payload_bytes, prompt_tokens=0, text_output_tokens=0,
+               image_output_tokens=0, total_tokens=0, output_size=None, status_code=None, finish_reason=None,
+               ok=True, template=None, tag=None, aspect_ratio=None, source=None):
+        now = time.time()
+        day = time.strftime("%Y-%m-%d", time.localtime(now))
+        output_tokens = text_output_tokens + image_output_tokens
+        cost = estimate_cost(model, prompt_tokens, text_output_tokens, image_output_tokens, self._prices)
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT INTO calls (created_at, day, source, model, template, tag, aspect_ratio, image_count,"
+                " payload_bytes, output_size, prompt_tokens, output_tokens, text_output_tokens,"
+                " image_output_tokens, total_tokens, cost_usd, latency_ms, status_code, finish_reason, ok)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (now, day, source, model, template, tag, aspect_ratio, image_count, payload_bytes, output_size,
+                 prompt_tokens, output_tokens, text_output_tokens, image_output_tokens, total_tokens, cost,
+                 latency_ms, status_code, finish_reason, 1 if ok else 0),
+            )
+            key = (day, source or "不明", model, template or "指定なし", tag or "なし",
+                   request_shape(image_count, output_size))
+            conn.execute(STATS_UPSERT, key + (0 if ok else 1, prompt_tokens, output_tokens, cost, latency_ms))
+            conn.execute(HISTOGRAM_UPSERT, key + ("latency", to_bucket(latency_ms)))
+            conn.execute(HISTOGRAM_UPSERT, key + ("cost", to_bucket(cost * 1_000_000)))
+
+    def report(self, since_day, include_builds=False):
+        # Loads the rollups for the period once; all dashboard figures come from it.
+        # Background library builds are left out unless include_builds, so they
+        # don't skew the figures for user traffic.
+        where = "day >= ?" if include_builds else "day >= ? AND source != ?"
+        params = (since_day,) if include_builds else (since_day, BUILD_SOURCE)
+        with self._connect() as conn:
+            stats = [dict(row) for row in conn.execute(f"SELECT * FROM daily_stats WHERE {where}", params)]
+            histograms = [dict(row) for row in conn.execute(f"SELECT * FROM daily_histograms WHERE {where}", params)]
+        return UsageReport(stats, histograms)
+
+
+class UsageReport:
+    def __init__(self, stats, histograms):
+        self.stats = stats
+        self.histograms = histograms
+
+    def _aggregate(self, key_fn):
+        # Groups stats and histograms by key_fn(row)
+        groups = {}
+        for row in self.stats:
+            group = groups.setdefault(key_fn(row), {
+                "calls": 0, "failures": 0, "prompt_tokens": 0, "output_tokens": 0,
+                "cost_usd": 0.0, "latency_ms": 0,
+                "histograms": {metric: {} for metric in METRICS},
+            })
+            for field in ("calls", "failures", "prompt_tokens", "output_tokens", "cost_usd", "latency_ms"):
+                group[field] += row[field]
+        for row in self.histograms:
+            group = groups.get(key_fn(row))
+            if group is not None:
+                histogram = group["histograms"][row["metric"]]
+                histogram[row["bucket"]] = histogram.get(row["bucket"], 0) + row["calls"]
+        return groups
+
+    @staticmethod
+    def _summarize(group):
+        latency = group["histograms"]["latency"]
+        cost = group["histograms"]["cost"]
+        return {
+            "calls": group["calls"],
+            "failures": group["failures"],
+            "total_cost_usd": group["cost_usd"],
+            "median_cost_usd": histogram_percentile(cost, 50) / 1_000_000,
+            "avg_output_tokens": group["output_tokens"] / group["calls"] if group["calls"] else 0,
+            "p50_latency_s": histogram_percentile(latency, 50) / 1000,
+            "p90_latency_s": histogram_percentile(latency, 90) / 1000,
+            "p99_latency_s": histogram_percentile(latency, 99) / 1000,
+        }
+
+    def summary(self):
+        groups = self._aggregate(lambda row: "all")
+        if not groups:
+            return None
+        return self._summarize(groups["all"])
+
+    def breakdown(self, group_by):
+        # Cost and latency percentiles per value of `group_by` (one of GROUP_COLUMNS)
+        if group_by not in GROUP_COLUMNS:
+            raise ValueError(f"group_by must be one of {GROUP_COLUMNS}")
+        rows = [
+            {group_by: key, **self._summarize(group)}
+            for key, group in self._aggregate(lambda row: row[group_by]).items()
+        ]
+        rows.sort(key=lambda row: row["total_cost_usd"], reverse=True)
+        return rows
+
+    def daily(self, group_by):
+        # Per-day cost and latency percentiles per value of `group_by`
+        if group_by not in GROUP_COLUMNS:
+            raise ValueError(f"group_by must be one of {GROUP_COLUMNS}")
+        rows = [
+            {"day": day, group_by: key, **self._summarize(group)}
+            for (day, key), group in self._aggregate(lambda row: (row["day"], row[group_by])).items()
+        ]
+        rows.sort(key=lambda row: row["day"])
+        return rows
+
+    def flagged_shapes(self):
+        # Request shapes whose median cost or latency is well above the overall median
+        overall = self.summary()
+        if overall is None:
+            return []
+
+        flagged = []
+        for row in self.breakdown("shape"):
+            if row["calls"] < SHAPE_MIN_CALLS:
+                continue
+            reasons = []
+            if overall["median_cost_usd"] > 0 and row["median_cost_usd"] >= overall["median_cost_usd"] * SHAPE_FLAG_RATIO:
+                reasons.append(f"コスト {row['median_cost_usd'] / overall['median_cost_usd']:.1f}倍")
+            if overall["p50_latency_s"] > 0 and row["p50_latency_s"] >= overall["p50_latency_s"] * SHAPE_FLAG_RATIO:
+                reasons.append(f"レイテンシ {row['p50_latency_s'] / overall['p50_latency_s']:.1f}倍")
+            if reasons:
+                flagged.append({**row, "reason": "、".join(reasons)})
+        return flagged